@@ -0,0 +1,1004 @@
+# Zachary Garrett
+
+import socket
+import threading
+import multiprocessing
+import DHTCodec
+import os
+import sys
+import random
+import tracemalloc
+from collections import deque, Counter
+from time import perf_counter, sleep
+import DHTTransport
+
+bench_port = 26990  # Loopback port the benchmark receivers listen on
+ring_port = 26700   # First port of the loopback ring, node i listens on ring_port + 2i (left) and + 2i + 1 (query)
+
+
+# Counts datagrams arriving on sock until a zero-length datagram says to stop
+def drain(sock, counter):
+    while True:
+        msg, addr = sock.recvfrom(65535)
+        if not msg:
+            break
+        counter[0] += 1
+
+
+# Starts a receiver thread on the benchmark port
+def start_receiver(port=bench_port):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4 * 1024 * 1024)
+    sock.bind(('127.0.0.1', port))
+    counter = [0]
+    thread = threading.Thread(target=drain, args=(sock, counter))
+    thread.start()
+    return sock, thread, counter
+
+
+# Stops a receiver started by start_receiver
+def stop_receiver(receiver, port=bench_port):
+    sock, thread, counter = receiver
+    stopper = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    stopper.sendto(b'', ('127.0.0.1', port))
+    stopper.close()
+    thread.join()
+    sock.close()
+    return counter[0]
+
+
+# Sends with a new socket per datagram, like DHTClient.send used to (closed here so the fds don't run out)
+def send_new_socket(data, addr):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.sendto(data, addr)
+    sock.close()
+
+
+# Datagrams/sec through a new socket per send vs the persistent DHTTransport socket
+def bench_send(count=50000, size=300):
+    data = b'x' * size
+    addr = ('127.0.0.1', bench_port)
+
+    for name, send in (("socket per send", send_new_socket), ("persistent socket", DHTTransport.send_bytes)):
+        receiver = start_receiver()
+        start = perf_counter()
+        for i in range(count):
+            send(data, addr)
+        elapsed = perf_counter() - start
+        received = stop_receiver(receiver)
+        print("%-20s %10.0f datagrams/sec  (%d/%d received)" % (name, count / elapsed, received, count))
+    DHTTransport.close_sender()
+
+
+# Retrieves 4-tuples (username, ipv4, portl, portq) for a loopback ring of n nodes
+def ring_tuples(n):
+    return [("node" + str(i), '127.0.0.1', str(ring_port + 2 * i), str(ring_port + 2 * i + 1)) for i in range(n)]
+
+
+# Runs one DHT client of the loopback ring, the leader (node 0) also sets the DHT up. With
+# counts, the node puts its number of rows and transport stats there every 0.2s
+def run_node(i, n, settings, ready, counts=None):
+    sys.stdout = open(os.devnull, 'w')   # Nodes print a line per message
+    import DHTClient
+    import DHTStorage
+    for name, value in settings.items():
+        setattr(DHTClient if hasattr(DHTClient, name) else DHTTransport, name, value)
+    if "storage" in settings or "indexed_columns" in settings:
+        DHTClient.hash_table = DHTStorage.new_store(DHTClient.storage, DHTClient.key_column, DHTClient.indexed_columns)
+
+    tuples = ring_tuples(n)
+    DHTClient.start_listening(dict(client_info=dict(ip='127.0.0.1', portl=tuples[i][2], portq=tuples[i][3])),
+                              [tuples[i][0]])
+    ready.put(i)
+
+    if i == 0:
+        while ready.qsize() > 0:     # Wait for the other nodes to be listening
+            sleep(0.05)
+        server = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)   # Stands in for the DHT server
+        server.bind(('127.0.0.1', 0))
+        DHTClient.config_dht_users(dict(tuples=tuples, dht_size=n, message='', serverAddr=server.getsockname()), [])
+        ready.put(i)
+    while True:
+        sleep(0.2)
+        if counts is not None:
+            counts.put((i, len(DHTClient.hash_table), DHTClient.transport_stats()))
+
+
+# Starts a loopback ring of n DHT clients, settings are DHTClient (or DHTTransport) globals to
+# override in every node
+def start_ring(n, counts=None, **settings):
+    ready = multiprocessing.Queue()
+    nodes = [multiprocessing.Process(target=run_node, args=(i, n, settings, ready, counts), daemon=True)
+             for i in range(n)]
+    for node in nodes[1:]:
+        node.start()
+    for i in range(n - 1):
+        ready.get()
+    nodes[0].start()
+    ready.get()     # Leader is listening
+    ready.get()     # Leader has set up the DHT and stored the csv
+    sleep(0.2)      # Let the last records reach their nodes
+    return nodes
+
+
+# Stops a ring started by start_ring
+def stop_ring(nodes):
+    for node in nodes:
+        node.terminate()
+    for node in nodes:
+        node.join()
+
+
+# Query round trip and per-hop latency on a loopback ring forwarding one node at a time
+def bench_latency(n=8, count=200):
+    import DHTClient
+    nodes = start_ring(n, routing_mode='ring')
+    tuples = ring_tuples(n)
+    names = [row["Long Name"] for row in DHTClient.read_from_csv()]
+
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.bind(('127.0.0.1', bench_port))
+    sock.settimeout(2)
+    total = 0.0
+    hops = 0
+    answered = 0
+    for i in range(count):
+        long_name = names[i % len(names)]
+        hash_output = DHTClient.compute_hash({"Long Name": long_name}, tuples)
+        query = dict(code="query", long_name=long_name, pos=hash_output["pos"], node_id=hash_output["node_id"],
+                     ring_size=n, return_addr=('127.0.0.1', bench_port))
+        start = perf_counter()
+        sock.sendto(DHTCodec.encode(query), ('127.0.0.1', ring_port + 1))     # Enter the ring at node 0
+        try:
+            reply = DHTCodec.decode(sock.recvfrom(65535)[0])
+        except socket.timeout:
+            continue
+        total += perf_counter() - start
+        hops += reply["hops"]
+        answered += 1
+    sock.close()
+    stop_ring(nodes)
+
+    # Each query also crosses client -> node 0 and owner -> client
+    print("%d/%d answered, %.3f ms per query, %.1f hops per query, %.3f ms per hop" % (
+        answered, count, 1000 * total / answered, hops / answered, 1000 * total / (hops + 2 * answered)))
+
+
+# Joins the loopback ring's process as a client that is not in the DHT. Its result cache is
+# off unless cache_entries is given, so every lookup goes through the ring
+def start_client(n, routing_mode='direct', cache_entries=0):
+    import DHTClient
+    DHTClient.routing_mode = routing_mode
+    DHTClient.known_addresses = ring_tuples(n)
+    DHTClient.result_cache.max_entries = cache_entries
+    DHTClient.result_cache.clear()
+    DHTClient.start_listening(dict(client_info=dict(ip='127.0.0.1', portl=bench_port, portq=bench_port + 1)),
+                              ["bench"])
+    return DHTClient
+
+
+# Lookups/sec with up to in_flight lookups outstanding at once
+def bench_lookups(n=8, count=5000, in_flight=64):
+    nodes = start_ring(n, routing_mode='finger')
+    client = start_client(n, 'finger')
+    names = [row["Long Name"] for row in client.read_from_csv()]
+
+    for mode in ('finger', 'direct'):
+        client.routing_mode = mode
+        for window in (1, in_flight):
+            outstanding = deque()
+            answered = 0
+            start = perf_counter()
+            for i in range(count):
+                if len(outstanding) >= window:
+                    answered += wait_lookup(outstanding.popleft())
+                outstanding.append(client.lookup(names[i % len(names)], ('127.0.0.1', ring_port + 1)))
+            while outstanding:
+                answered += wait_lookup(outstanding.popleft())
+            elapsed = perf_counter() - start
+            print("%-6s routing, %3d in flight: %8.0f lookups/sec (%d/%d answered)" % (
+                mode, window, count / elapsed, answered, count))
+
+    client.stop_listening()
+    DHTTransport.close_sender()
+    stop_ring(nodes)
+
+
+# Sends rate store_row messages a second into node 0 of a loopback ring of n nodes for
+# seconds, then puts the number sent on results
+def run_writer(n, seconds, rate, results):
+    sys.stdout = open(os.devnull, 'w')
+    import DHTClient
+    DHTClient.start_listening(dict(client_info=dict(ip='127.0.0.1', portl=bench_port + 2, portq=bench_port + 3)),
+                              ["writer"])
+    tuples = ring_tuples(n)
+    sent = 0
+    start = perf_counter()
+    for row in synthetic_rows(100000000, start=2000000):
+        now = perf_counter()
+        if now - start >= seconds:
+            break
+        if sent > (now - start) * rate:
+            sleep(sent / rate - (now - start))
+        row.update(DHTClient.compute_hash(row, tuples))
+        DHTClient.send(dict(code="store_row", data_row=row), (tuples[0][1], tuples[0][2]), ring=True)
+        sent += 1
+    results.put(sent)
+    DHTClient.stop_listening()
+    DHTTransport.close_sender()
+
+
+# Lookups/sec and their latency on a loopback ring while another process writes rate rows a
+# second into it, with queries answered on the listener thread and by each number of query workers
+def bench_mixed(n=4, seconds=10, rate=2000, in_flight=32, *worker_counts):
+    for workers in worker_counts or (0, 4):
+        nodes = start_ring(n, routing_mode='finger', query_workers=workers)
+        results = multiprocessing.Queue()
+        writer = multiprocessing.Process(target=run_writer, args=(n, seconds, rate, results))
+        writer.start()
+        client = start_client(n, 'finger')
+        names = [row["Long Name"] for row in client.read_from_csv()]
+
+        outstanding = deque()
+        latencies = []
+        answered = 0
+        start = perf_counter()
+        i = 0
+        while perf_counter() - start < seconds or outstanding:
+            if len(outstanding) >= in_flight or outstanding and perf_counter() - start >= seconds:
+                future, sent = outstanding.popleft()
+                if wait_lookup(future):
+                    answered += 1
+                    latencies.append(perf_counter() - sent)
+                continue
+            outstanding.append((client.lookup(names[i % len(names)], ('127.0.0.1', ring_port + 1)), perf_counter()))
+            i += 1
+        elapsed = perf_counter() - start
+        written = results.get()
+        writer.join()
+        client.stop_listening()
+        DHTTransport.close_sender()
+        stop_ring(nodes)
+
+        latencies.sort()
+        print("%d query workers: %6.0f lookups/sec (%d/%d answered), p50 %6.1f ms, p99 %6.1f ms, %6.0f rows/sec written"
+              % (workers, answered / elapsed, answered, i, 1000 * latencies[len(latencies) // 2],
+                 1000 * latencies[int(len(latencies) * 0.99)], written / seconds))
+
+
+# Keys/sec of one mget for every country vs querying them one at a time
+def bench_mget(n=8, rounds=5):
+    nodes = start_ring(n, routing_mode='finger')
+    client = start_client(n, 'finger')
+    names = [row["Long Name"] for row in client.read_from_csv()]
+    entry_addr = ('127.0.0.1', ring_port + 1)
+
+    for mode in ('finger', 'direct'):
+        client.routing_mode = mode
+        start = perf_counter()
+        answered = 0
+        for i in range(rounds):
+            for long_name in names:
+                answered += wait_lookup(client.lookup(long_name, entry_addr))
+        serial = perf_counter() - start
+
+        start = perf_counter()
+        found = 0
+        for i in range(rounds):
+            found += len(client.mget(names, entry_addr))
+        batched = perf_counter() - start
+        keys = rounds * len(names)
+        print("%-6s routing: serial %8.0f keys/sec (%d/%d), mget %8.0f keys/sec (%d/%d)" % (
+            mode, keys / serial, answered, keys, keys / batched, found, keys))
+
+    client.stop_listening()
+    DHTTransport.close_sender()
+    stop_ring(nodes)
+
+
+# Waits for a lookup, returns 1 if it was answered
+def wait_lookup(future):
+    try:
+        future.result()
+        return 1
+    except TimeoutError:
+        return 0
+
+
+# One message of every kind the ring sends, filled in from the csv
+def sample_messages():
+    import DHTClient
+    DHTClient.ring_size = 8
+    data = list(DHTClient.read_from_csv())
+    row = data[0]
+    tuples = ring_tuples(8)
+    record = dict((key, value) for key, value in row.items() if key not in ("pos", "node_id", "key_hash"))
+    addr = ('127.0.0.1', ring_port)
+    header = list(row)
+    rows = [DHTCodec.pack_value(list(r.values())) for r in data[:100]]
+    return dict(
+        setup=dict(code="setup", next=addr, ring_size=8, identifier=3, all_addresses=tuples, wire_format='binary'),
+        store_row=dict(code="store_row", data_row=row),
+        migrate=dict(code="migrate", header=header, rows=rows, request_id=12345, return_addr=addr,
+                     key_column="Long Name"),
+        query=dict(code="query", long_name=row["Long Name"], pos=row["pos"], node_id=row["node_id"], ring_size=8,
+                   return_addr=addr, request_id=12345, hops=2, key_hash=row["key_hash"], hash_name='blake2b'),
+        query_success=dict(code="query_success", long_name=row["Long Name"], record=record, hops=2, request_id=12345,
+                           message="Data Record for " + row["Long Name"] + ":\n" + str(record)),
+        mquery=dict(code="mquery", keys=[(r["Long Name"], r["pos"]) for r in data[:64]], node_id=3, ring_size=8,
+                    return_addr=addr, request_id=12345),
+        teardown=dict(code="teardown", serverAddr=addr, message="", tuples=tuples),
+        SUCCESS=dict(code="SUCCESS", msg="", added=dict(tuple=tuples[0], tuples=tuples))
+    )
+
+
+# Encode/decode throughput and bytes per message, pickle vs the DHTCodec binary format
+def bench_codec(count=20000):
+    print("%-14s %8s %8s %12s %12s %12s %12s" % (
+        "message", "pickle B", "binary B", "pickle enc/s", "binary enc/s", "pickle dec/s", "binary dec/s"))
+    for code, msg in sample_messages().items():
+        results = []
+        for wire_format in ('pickle', 'binary'):
+            data = DHTCodec.encode(msg, wire_format)
+            assert DHTCodec.decode(data, True) == msg
+            start = perf_counter()
+            for i in range(count):
+                DHTCodec.encode(msg, wire_format)
+            encode_rate = count / (perf_counter() - start)
+            start = perf_counter()
+            for i in range(count):
+                DHTCodec.decode(data, True)
+            decode_rate = count / (perf_counter() - start)
+            results.append((len(data), encode_rate, decode_rate))
+        print("%-14s %8d %8d %12.0f %12.0f %12.0f %12.0f" % (
+            code, results[0][0], results[1][0], results[0][1], results[1][1], results[0][2], results[1][2]))
+
+
+# Per-node and per-slot load of the csv's keys under every hash function
+def bench_distribution(n=8):
+    import DHTClient
+    import DHTHash
+    keys = [row["Long Name"] for row in DHTClient.read_from_csv()]
+    print("%d keys, %d nodes, %d slots" % (len(keys), n, DHTHash.table_size))
+    print("%-8s %10s %9s %9s %9s %10s %10s %11s" % (
+        "hash", "keys/sec", "min/node", "max/node", "max/slot", "used slots", "slot coll.", "64-bit coll."))
+
+    for name, hash_function in DHTHash.hash_functions.items():
+        start = perf_counter()
+        hashes = [hash_function(key) for key in keys]
+        rate = len(keys) / (perf_counter() - start)
+
+        slots = dict()
+        for key_hash in hashes:
+            pos = key_hash % DHTHash.table_size
+            slots[pos] = slots.get(pos, 0) + 1
+        nodes = [0] * n
+        for key_hash in hashes:
+            nodes[key_hash % n] += 1
+        print("%-8s %10.0f %9d %9d %9d %10d %10d %11d" % (
+            name, rate, min(nodes), max(nodes), max(slots.values()), len(slots), len(keys) - len(slots),
+            len(keys) - len(set(hashes))))
+
+
+# Synthetic rows with the StatsCountry columns, every value a separate string like rows parsed from a csv
+def synthetic_rows(count, header=None, start=0):
+    if header is None:
+        import DHTClient
+        header = [column for column in next(DHTClient.read_from_csv()) if column not in ("pos", "node_id", "key_hash")]
+    for i in range(start, start + count):
+        yield dict((column, column[:3] + "-" + str(i)) if column != "Long Name" else (column, "Country " + str(i))
+                   for column in header)
+
+
+# Memory per row and lookup latency of the node storage vs keeping a dict per row
+def bench_storage(*sizes):
+    import DHTStorage
+    for count in sizes or (10000, 100000):
+        keys = ["Country " + str(random.randrange(count)) for i in range(100000)]
+        print("%d rows per node" % count)
+
+        for name, store in (("dict per row", dict()), ("NodeStore", DHTStorage.NodeStore())):
+            tracemalloc.start()
+            before = tracemalloc.get_traced_memory()[0]
+            if isinstance(store, dict):
+                for row in synthetic_rows(count):
+                    store[row["Long Name"]] = row
+            else:
+                for row in synthetic_rows(count):
+                    store.put(row)
+            used = tracemalloc.get_traced_memory()[0] - before
+            tracemalloc.stop()
+
+            start = perf_counter()
+            for key in keys:
+                store.get(key)
+            elapsed = perf_counter() - start
+            print("  %-14s %6.0f bytes/row  %6.0f ns/lookup" % (name, used / count, 1e9 * elapsed / len(keys)))
+            del store
+
+
+# Rows with the StatsCountry columns and values, cycling through the csv with a unique key and
+# country code, every value a new string like rows parsed from a csv
+def stats_country_rows(count):
+    import DHTClient
+    rows = [dict((column, value) for column, value in row.items() if column not in ("pos", "node_id", "key_hash"))
+            for row in DHTClient.read_from_csv()]
+    for i in range(count):
+        row = dict((column, value.encode().decode()) for column, value in rows[i % len(rows)].items())
+        row["Long Name"] += " " + str(i)
+        row["Country Code"] += str(i)
+        yield row
+
+
+# Rows of a wide schema: a unique key, 9 more unique columns and 50 columns of 2 to 1000 distinct values
+def wide_rows(count):
+    for i in range(count):
+        row = dict(("id" + str(c), "id" + str(c) + "-" + str(i)) for c in range(10))
+        row.update(("col" + str(c), "value " + str(i % (2 + c * 20))) for c in range(50))
+        row["Long Name"] = "Row " + str(i)
+        yield row
+
+
+# Memory per row and lookup latency of a dict per row, NodeStore and ColumnStore for the
+# StatsCountry schema and a wide one. Counts the values the store keeps, so a value shared
+# between rows is counted once
+def bench_columns(count=100000):
+    import DHTStorage
+    for schema, rows in (("StatsCountry", stats_country_rows), ("wide", wide_rows)):
+        keys = [row["Long Name"] for row in rows(count)]
+        lookups = [random.choice(keys) for i in range(100000)]
+        print("%s schema, %d columns, %d rows" % (schema, len(next(rows(1))), count))
+        for name, store in (("dict per row", dict()), ("NodeStore", DHTStorage.NodeStore()),
+                            ("ColumnStore", DHTStorage.ColumnStore())):
+            tracemalloc.start()
+            before = tracemalloc.get_traced_memory()[0]
+            start = perf_counter()
+            for row in rows(count):
+                if isinstance(store, dict):
+                    store[row["Long Name"]] = row
+                else:
+                    store.put(row)
+            stored = perf_counter() - start
+            used = tracemalloc.get_traced_memory()[0] - before
+            tracemalloc.stop()
+
+            get = store.get
+            start = perf_counter()
+            for key in lookups:
+                get(key)
+            elapsed = perf_counter() - start
+            print("  %-14s %6.0f bytes/row  %6.2f us/put (traced)  %6.0f ns/lookup" % (
+                name, used / count, 1e6 * stored / count, 1e9 * elapsed / len(lookups)))
+            del store
+
+
+# Time to write a node's rows into a snapshot as they arrive, to map it again on restart and
+# to read from it, vs putting the same rows in a NodeStore as a reload has to
+def bench_snapshot(count=1000000):
+    import tempfile
+    import DHTStorage
+    path = os.path.join(tempfile.mkdtemp(), "node")
+    keys = [row["Long Name"] for row in synthetic_rows(min(count, 10000))]
+    print("%d rows" % count)
+
+    store = DHTStorage.NodeStore()
+    start = perf_counter()
+    for row in synthetic_rows(count):
+        store.put(row)
+    print("  NodeStore reload      %8.3fs (%8.0f rows/sec)" % (perf_counter() - start, count / (perf_counter() - start)))
+    del store
+
+    snapshot = DHTStorage.SnapshotStore()
+    snapshot.open(path, "bench")
+    start = perf_counter()
+    for row in synthetic_rows(count):
+        snapshot.put(row)
+    elapsed = perf_counter() - start
+    snapshot.close()
+    size = sum(os.path.getsize(path + suffix) for suffix in (".index", ".heap", ".headers"))
+    print("  snapshot writes       %8.3fs (%8.0f rows/sec), %.0f MB on disk" % (elapsed, count / elapsed, size / 1e6))
+
+    start = perf_counter()
+    restored = DHTStorage.SnapshotStore().open(path, "bench")
+    print("  snapshot restore      %8.3fms, restored %s" % (1000 * (perf_counter() - start), restored))
+    snapshot = DHTStorage.SnapshotStore()
+    snapshot.open(path, "bench")
+    start = perf_counter()
+    for key in keys:
+        assert snapshot.get(key) is not None
+    print("  snapshot lookups      %8.0f ns/lookup" % (1e9 * (perf_counter() - start) / len(keys)))
+    snapshot.close()
+    for suffix in (".index", ".heap", ".headers"):
+        os.remove(path + suffix)
+
+
+# Sends count store_row messages into node 0 of a loopback ring of n nodes that forwards
+# them one node at a time, or with path stores the count rows of that csv in acked batches
+# sent straight to each node. settings are DHTClient (or DHTTransport) globals to override
+# in every process. Waits until every row is stored or the counts stop changing for 3s and
+# returns the rows stored, the seconds that took and the counters of all processes summed
+def send_ring_rows(n, count, path=None, **settings):
+    import DHTClient
+    saved = dict()
+    for name, value in settings.items():
+        module = DHTClient if hasattr(DHTClient, name) else DHTTransport
+        saved[(module, name)] = getattr(module, name)
+        setattr(module, name, value)
+    DHTTransport.stats.clear()  # Forked nodes start with the counts of this process
+    counts = multiprocessing.Queue()
+    nodes = start_ring(n, counts, routing_mode='ring', batch_store=False, **settings)
+    client = start_client(n, 'ring')
+    entry = ring_tuples(n)[0]
+    start = perf_counter()
+    if path is not None:
+        client.dht_addresses = ring_tuples(n)
+        client.ring_size = n
+        client.store_rows(client.read_from_csv(path))
+    for row in synthetic_rows(0 if path else count, start=1000000):
+        row.update(client.compute_hash(row, ring_tuples(n)))
+        client.send(dict(code="store_row", data_row=row), (entry[1], entry[2]), ring=True)
+
+    stored = dict()
+    node_stats = dict()
+    changed = perf_counter()
+    while sum(stored.values()) < count + 241 and perf_counter() - changed < 3:
+        i, rows, transport = counts.get()
+        if stored.get(i) != rows:
+            changed = perf_counter()
+        stored[i] = rows
+        node_stats[i] = transport
+    elapsed = changed - start
+    node_stats["client"] = client.transport_stats()
+    client.stop_listening()
+    DHTTransport.close_sender()
+    stop_ring(nodes)
+    for (module, name), value in saved.items():
+        setattr(module, name, value)
+
+    totals = Counter()
+    for transport in node_stats.values():
+        totals.update(dict((name, value) for name, value in transport.items() if value))
+    return sum(stored.values()) - 241, elapsed, totals
+
+
+# Loss injection on loopback: sends count rows around a ring (see send_ring_rows) with
+# drop_percent of all datagrams (acks too) thrown away by every process, with and without
+# the reliable channel, and counts the rows stored
+def bench_loss(n=4, count=20000, *drop_percents):
+    for drop_percent in drop_percents or (0, 1, 5, 10):
+        for reliable in (False, True):
+            stored, elapsed, totals = send_ring_rows(n, count, reliable_ring=reliable, drop_rate=drop_percent / 100)
+            print("drop %2d%%  %-10s %6d/%d rows stored in %6.2fs, %6d retransmits, %6d duplicates, %d given up" % (
+                drop_percent, "reliable" if reliable else "plain", stored, count, elapsed, totals["retransmits"],
+                totals["duplicates"], totals["given_up"]))
+
+
+# Rows/sec a loopback ring sustains, and the rows it loses, without the reliable channel, with
+# a fixed window and with the congestion window, each with the OS and with 1 MB socket buffers
+def bench_flow(n=4, count=20000):
+    configs = (
+        ("plain, OS buffers", dict(reliable_ring=False, receive_buffer=0)),
+        ("plain, 1 MB buffers", dict(reliable_ring=False, receive_buffer=1 << 20)),
+        ("fixed window of 64", dict(congestion_control=False, window=64, receive_buffer=0)),
+        ("AIMD, OS buffers", dict(receive_buffer=0)),
+        ("AIMD, 1 MB buffers", dict(receive_buffer=1 << 20))
+    )
+    for label, settings in configs:
+        stored, elapsed, totals = send_ring_rows(n, count, **settings)
+        print("%-20s %6d/%d rows stored, %7.0f rows/sec, %6d kernel drops, %6d resent, %4d window cuts" % (
+            label, stored, count, stored / elapsed, totals["receive_drops"], totals["retransmits"],
+            totals["window_cuts"]))
+
+
+# Rows/sec of the udp and tcp transports side by side on a loopback ring: count single rows
+# forwarded one node at a time, then a csv of rows rows stored in batches, which are up to
+# DHTClient.batch_bytes over udp and stream_batch_bytes over tcp
+def bench_transport(n=4, count=20000, rows=200000):
+    path = '/tmp/dht_transport_' + str(rows) + '.csv'
+    write_csv(path, None, rows)
+    for load, load_path, total in (("store_row", None, count), ("batches", path, rows)):
+        for transport in ('udp', 'tcp'):
+            stored, elapsed, totals = send_ring_rows(n, total, load_path, transport=transport)
+            print("%-9s over %s %7d/%d rows stored, %7.0f rows/sec, %6d datagrams, %6d tcp messages in %5d writes"
+                  % (load, transport, stored, total, stored / elapsed, totals["datagrams_sent"],
+                     totals["stream_messages"], totals["stream_writes"]))
+
+
+# Keys that change node, and the time to place every key again, when a node joins or leaves
+def bench_placement(*sizes, keys=100000):
+    import DHTClient
+    import DHTHash
+    key_hashes = [DHTHash.blake2b_hash("Country " + str(i)) for i in range(keys)]
+    print("%d keys" % keys)
+
+    for n in sizes or (10, 50, 100):
+        members = ring_tuples(n + 1)[:n]
+        changes = (("leave", members[:n // 2] + members[n // 2 + 1:]), ("join", ring_tuples(n + 1)))
+        for mode in ('modulo', 'consistent'):
+            DHTClient.placement = mode
+            before = [members[DHTClient.place(key_hash, members)][0] for key_hash in key_hashes]
+            for change, after_members in changes:
+                start = perf_counter()
+                moved = sum(before[i] != after_members[DHTClient.place(key_hash, after_members)][0]
+                            for i, key_hash in enumerate(key_hashes))
+                elapsed = perf_counter() - start
+                print("%3d nodes, %-10s %-5s: %6d keys moved (%5.1f%%), placed again in %.3fs" % (
+                    n, mode, change, moved, 100.0 * moved / keys, elapsed))
+
+
+# Records/sec this process hands to a loopback ring with migrate batches, for several ack windows
+def bench_migration(n=8, count=20000):
+    nodes = start_ring(n)
+    client = start_client(n)
+    members = ring_tuples(n)
+
+    for window in (1, 8, 32):
+        client.migrate_window = window
+        for row in synthetic_rows(count):
+            client.hash_table.put(row)
+        start = perf_counter()
+        client.migrate_records(members)    # This process is not a member, so every record moves
+        elapsed = perf_counter() - start
+        print("window %2d: %8.0f records/sec (%d/%d acked)" % (
+            window, count / elapsed, count - len(client.hash_table), count))
+        client.hash_table.clear()
+
+    client.stop_listening()
+    DHTTransport.close_sender()
+    stop_ring(nodes)
+
+
+# Server commands/sec with many registered clients, almost all of them free
+def bench_server(*sizes, count=20000):
+    import importlib
+    import DHTServer
+    for n in sizes or (10000, 100000):
+        server = importlib.reload(DHTServer)     # Fresh server state
+        for i in range(n):
+            server.handle_command("register user" + str(i) + " 127.0.0.1 26500 26501")
+        server.handle_command("setup-dht 8 user0")
+        server.handle_command("dht-complete user0")
+
+        start = perf_counter()
+        for i in range(count):
+            server.handle_command("query-dht user" + str(8 + i % (n - 8)))
+        queries = perf_counter() - start
+
+        start = perf_counter()
+        rebuilds = count // 10
+        for i in range(rebuilds):
+            member = server.dht_info[1 + i % 7][0]
+            server.handle_command("leave-dht " + member)
+            server.handle_command("dht-rebuilt " + member + " user0")
+            server.handle_command("join-dht " + member)
+            server.handle_command("dht-rebuilt " + member + " user0")
+        changes = perf_counter() - start
+        print("%6d clients: query-dht %8.0f/sec, leave+join %8.0f/sec" % (
+            n, count / queries, rebuilds / changes))
+
+
+# Sends commands to the server at addr and records the round trip of each
+def server_client(addr, commands, latencies):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.settimeout(5)
+    for command in commands:
+        start = perf_counter()
+        sock.sendto(command.encode('utf-8'), addr)
+        try:
+            sock.recvfrom(65535)
+        except socket.timeout:
+            continue
+        latencies.append(perf_counter() - start)
+    sock.close()
+
+
+# Requests/sec and latency of a server process under many clients at once, per worker count
+def bench_server_load(clients=32, requests=500, *worker_counts):
+    import subprocess
+    addr = ('127.0.0.1', bench_port)
+    for workers in worker_counts or (0, 4):
+        server = subprocess.Popen([sys.executable, 'DHTServer.py', str(bench_port), str(workers)],
+                                  stdout=subprocess.DEVNULL)
+        sleep(0.5)
+        setup = ["register node" + str(i) + " 127.0.0.1 26500 26501" for i in range(8)]
+        server_client(addr, setup + ["setup-dht 8 node0", "dht-complete node0"], [])
+
+        # Every client registers under new names and queries the DHT in turn
+        latencies = []
+        threads = []
+        for c in range(clients):
+            commands = []
+            for i in range(requests // 2):
+                commands.append("register user" + str(c) + "-" + str(i) + " 127.0.0.1 26500 26501")
+                commands.append("query-dht user" + str(c) + "-" + str(i))
+            threads.append(threading.Thread(target=server_client, args=(addr, commands, latencies)))
+        start = perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = perf_counter() - start
+        server.kill()
+        server.wait()
+
+        latencies.sort()
+        print("%d workers: %8.0f requests/sec, p50 %.2f ms, p99 %.2f ms (%d/%d answered)" % (
+            workers, len(latencies) / elapsed, 1000 * latencies[len(latencies) // 2],
+            1000 * latencies[len(latencies) * 99 // 100], len(latencies), clients * (requests // 2) * 2))
+
+
+# Hops per lookup, and how the reads of one hot key spread over the nodes, per replication factor
+def bench_replicas(n=8, count=3000, in_flight=64):
+    from collections import Counter
+    entry_addr = ('127.0.0.1', ring_port + 1)
+    for factor in (1, 2, 3):
+        nodes = start_ring(n, routing_mode='finger', replicas=factor)
+        client = start_client(n, 'finger')
+        client.replicas = factor
+        names = [row["Long Name"] for row in client.read_from_csv()]
+
+        hops = 0
+        found = 0
+        for long_name in names:
+            reply = client.lookup(long_name, entry_addr).result()
+            hops += reply["hops"]
+            found += reply["code"] == "query_success"
+
+        # Every lookup asks for the same key, the client sends each to the replica it has the fewest lookups at
+        client.routing_mode = 'direct'
+        answered_by = Counter()
+        outstanding = deque()
+        start = perf_counter()
+        for i in range(count):
+            if len(outstanding) >= in_flight:
+                answered_by[outstanding.popleft().result()["replica"]] += 1
+            outstanding.append(client.lookup(names[0]))
+        while outstanding:
+            answered_by[outstanding.popleft().result()["replica"]] += 1
+        elapsed = perf_counter() - start
+        print("replicas %d: %d/%d found, %.2f hops per lookup (finger); hot key %6.0f lookups/sec, answered by %s" % (
+            factor, found, len(names), hops / len(names), count / elapsed, sorted(answered_by.values(), reverse=True)))
+
+        client.stop_listening()
+        DHTTransport.close_sender()
+        stop_ring(nodes)
+
+
+# Lookups/sec and cache hit rate for a skewed workload (a few countries get most lookups), per cache size
+def bench_cache(n=8, count=20000, skew=1.1):
+    nodes = start_ring(n, routing_mode='finger')
+    client = start_client(n, 'finger')
+    names = [row["Long Name"] for row in client.read_from_csv()]
+    rng = random.Random(1)
+    weights = [1 / (rank + 1) ** skew for rank in range(len(names))]   # Zipf
+    workload = rng.choices(names, weights, k=count)
+    entry_addr = ('127.0.0.1', ring_port + 1)
+
+    for entries in (0, 16, 64, 1024):
+        client.result_cache = client.DHTCache.LRUCache(entries, client.cache_ttl)
+        answered = 0
+        start = perf_counter()
+        for long_name in workload:
+            answered += wait_lookup(client.lookup(long_name, entry_addr))
+        elapsed = perf_counter() - start
+        stats = client.result_cache.stats()
+        print("%4d entries: %8.0f lookups/sec, %5.1f%% hits (%d/%d answered)" % (
+            entries, count / elapsed, 100.0 * stats["hits"] / count, answered, count))
+
+    client.stop_listening()
+    DHTTransport.close_sender()
+    stop_ring(nodes)
+
+
+# Writes a csv of about size_mb megabytes, or of rows rows, with the StatsCountry columns, unless it exists
+def write_csv(path, size_mb, rows=None):
+    import csv
+    if os.path.exists(path):
+        return
+    header = list(next(synthetic_rows(1)))
+    with open(path, 'w', newline='', encoding='utf-8') as out:
+        writer = csv.writer(out)
+        writer.writerow(header)
+        i = 0
+        while out.tell() < size_mb * 1024 * 1024 if rows is None else i < rows:
+            for row in synthetic_rows(10000 if rows is None else min(10000, rows - i), header, start=i):
+                writer.writerow(row.values())
+            i += 10000
+
+
+# Stands in for a DHT node: acks every migrate batch sent to its left port without storing it
+def run_sink(i, ready):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4 * 1024 * 1024)
+    sock.bind(('127.0.0.1', ring_port + 2 * i))
+    DHTTransport.open_sender(sock)  # Frames are acked from the port they were sent to, like a node does
+    ready.put(i)
+    while True:
+        data, addr = sock.recvfrom(65535)
+        for payload in DHTTransport.accept(data, addr):
+            msg = DHTCodec.decode(payload)
+            ack = dict(code="migrate_ack", stored=len(msg["rows"]), request_id=msg["request_id"], message="")
+            sock.sendto(DHTCodec.encode(ack), (msg["return_addr"][0], int(msg["return_addr"][1])))
+        DHTTransport.flush_acks()
+
+
+# Loads the csv at path into n sinks, either streaming it, reading it into a list first like
+# read_from_csv used to, or parsing it in worker processes ('parallel'), and reports the times
+# and the peak RSS of the loading process
+def run_ingest(path, n, mode, results, workers=0, hash_name='blake2b'):
+    import resource
+    import DHTClient
+    DHTClient.dht_addresses = ring_tuples(n)
+    DHTClient.ring_size = n
+    DHTClient.hash_name = hash_name
+    DHTClient.ingest_workers = workers
+    DHTClient.start_listening(dict(client_info=dict(ip='127.0.0.1', portl=bench_port, portq=bench_port + 1)),
+                              ["loader"])
+    start = perf_counter()
+    parsed = 0
+    if mode == 'parallel':
+        stats = DHTClient.store_parallel(path)
+    else:
+        rows = DHTClient.read_from_csv(path)
+        if mode == 'list':
+            rows = list(rows)
+        parsed = perf_counter() - start     # Seconds before the first row reached store_rows
+        stats = DHTClient.store_rows(rows)
+    DHTClient.stop_listening()
+    DHTTransport.close_sender()
+    results.put((mode, stats["rows"], stats["unacked"], parsed + stats["first_batch"], perf_counter() - start,
+                 resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024))
+
+
+# Peak RSS and time to the first stored batch when loading a large csv, streamed vs read into a list
+def bench_ingest(size_mb=1024, n=4):
+    path = '/tmp/dht_ingest_' + str(size_mb) + 'mb.csv'
+    write_csv(path, size_mb)
+    ready = multiprocessing.Queue()
+    sinks = [multiprocessing.Process(target=run_sink, args=(i, ready), daemon=True) for i in range(n)]
+    for sink in sinks:
+        sink.start()
+    for sink in sinks:
+        ready.get()
+
+    print("%s, %.0f MB" % (path, os.path.getsize(path) / 1024 / 1024))
+    for mode in ('list', 'stream'):
+        results = multiprocessing.Queue()
+        loader = multiprocessing.Process(target=run_ingest, args=(path, n, mode, results))
+        loader.start()
+        mode, rows, unacked, first, total, rss = results.get()
+        loader.join()
+        print("%-6s %9d rows (%d unacked): first batch after %7.3fs, done in %6.1fs (%7.0f rows/sec), peak RSS %6.0f MB"
+              % (mode, rows, unacked, first, total, rows / total, rss))
+    stop_ring(sinks)
+
+
+# Rows per second of hashing and partitioning a csv of rows rows alone, and of loading it into
+# n sinks, read on the loading thread and with each number of worker processes. fnv1a is also
+# run without numpy when it is installed
+def bench_parallel(rows=1000000, n=4, *worker_counts):
+    import DHTIngest
+    path = '/tmp/dht_parallel_' + str(rows) + '.csv'
+    write_csv(path, None, rows)
+    worker_counts = worker_counts or sorted({1, 2, 4, os.cpu_count()})
+    ready = multiprocessing.Queue()
+    sinks = [multiprocessing.Process(target=run_sink, args=(i, ready), daemon=True) for i in range(n)]
+    for sink in sinks:
+        sink.start()
+    for sink in sinks:
+        ready.get()
+
+    print("%s, %d rows, %d cores, numpy %s" % (path, rows, os.cpu_count(),
+                                             "installed" if DHTIngest.numpy is not None else "not installed"))
+    names = tuple(name for name, ip, portl, portq in ring_tuples(n))
+    header, ranges = DHTIngest.split_file(path)
+    runs = [("blake2b", True), ("fnv1a", True)] + ([("fnv1a", False)] if DHTIngest.numpy is not None else [])
+    for hash_name, vectorized in runs:
+        label = hash_name + ("" if vectorized or hash_name not in DHTIngest.vector_hashes else " (no numpy)")
+        settings = dict(key_column="Long Name", hash_name=hash_name, placement='modulo', vnodes=64, names=names)
+        saved = DHTIngest.numpy
+        if not vectorized:
+            DHTIngest.numpy = None
+        start = perf_counter()
+        for byte_range in ranges:
+            DHTIngest.partition_chunk(path, *byte_range, header, settings)
+        DHTIngest.numpy = saved
+        partitioned = perf_counter() - start
+        print("%-18s partition only, 1 process: %8.0f rows/sec" % (label, rows / partitioned))
+        if not vectorized:
+            continue
+
+        baseline = None
+        for workers in (0,) + tuple(worker_counts):
+            results = multiprocessing.Queue()
+            mode = 'parallel' if workers else 'stream'
+            loader = multiprocessing.Process(target=run_ingest, args=(path, n, mode, results, workers, hash_name))
+            loader.start()
+            mode, stored, unacked, first, total, rss = results.get()
+            loader.join()
+            baseline = baseline or total
+            print("%-18s %d workers: %8.0f rows/sec, %5.2fx the loading thread, first batch after %6.3fs, "
+                  "%d unacked" % (label, workers, stored / total, baseline / total, first, unacked))
+    stop_ring(sinks)
+
+
+# Scans of a loopback ring of n nodes holding count StatsCountry rows (see stats_country_rows):
+# every row, a key prefix, a key range and a region, with Region indexed and not. The first
+# scan builds the index of every node and is timed apart. The prefix and the range are also
+# found by scanning every row and filtering at the client, which is how they had to be done
+def bench_scan(n=4, count=200000, rounds=5):
+    tuples = ring_tuples(n)
+    for columns in ((), ("Region",)):
+        nodes = start_ring(n, indexed_columns=columns)
+        client = start_client(n)
+        client.dht_addresses = tuples
+        client.ring_size = n
+        rows = stats_country_rows(count)
+        client.store_rows(dict(row, **client.compute_hash(row, tuples)) for row in rows)
+        entry = ('127.0.0.1', tuples[0][3])
+        total = count + 241     # The leader stored the csv too
+        start = perf_counter()
+        found = client.scan(entry_addr=entry, timeout=10).result()
+        first = perf_counter() - start
+        while perf_counter() - start < 10 and len(found) < total:
+            sleep(0.2)
+            found = client.scan(entry_addr=entry, timeout=10).result()
+
+        scans = (
+            ("every row", dict()),
+            ("prefix", dict(prefix="Kingdom of Spain")),
+            ("range", dict(start="Republic of A", end="Republic of C")),
+            ("region", dict(column="Region", value="South Asia")),
+            ("prefix, filtered", dict(prefix="Kingdom of Spain", filter=True)),
+            ("range, filtered", dict(start="Republic of A", end="Republic of C", filter=True))
+        )
+        print("Region %s, %d/%d rows, first scan %.1f ms" % ("indexed" if columns else "not indexed", len(found),
+                                                               total, 1000 * first))
+        for label, conditions in scans:
+            conditions = dict(conditions)
+            filtered = conditions.pop("filter", False)
+            start = perf_counter()
+            for i in range(rounds):
+                found = client.scan(entry_addr=entry, timeout=10, **({} if filtered else conditions)).result()
+                if filtered:
+                    found = [row for row in found if row["Long Name"].startswith(conditions.get("prefix", "")) and
+                             conditions.get("start", "") <= row["Long Name"] < conditions.get("end", "\U0010ffff")]
+            elapsed = (perf_counter() - start) / rounds
+            print("  %-17s %7d rows, %8.1f ms per scan, %9.0f rows/sec" % (
+                label, len(found), 1000 * elapsed, len(found) / elapsed))
+        client.stop_listening()
+        DHTTransport.close_sender()
+        stop_ring(nodes)
+
+
+# Benchmarks that can be run from the command line
+benchmarks = dict(
+    send=bench_send,
+    latency=bench_latency,
+    lookups=bench_lookups,
+    mget=bench_mget,
+    codec=bench_codec,
+    distribution=bench_distribution,
+    storage=bench_storage,
+    placement=bench_placement,
+    migration=bench_migration,
+    server=bench_server,
+    server_load=bench_server_load,
+    replicas=bench_replicas,
+    cache=bench_cache,
+    ingest=bench_ingest,
+    parallel=bench_parallel,
+    columns=bench_columns,
+    snapshot=bench_snapshot,
+    loss=bench_loss,
+    flow=bench_flow,
+    transport=bench_transport,
+    mixed=bench_mixed,
+    scan=bench_scan
+)
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2 or sys.argv[1] not in benchmarks:
+        print("Usage: python DHTBenchmark.py <" + "|".join(benchmarks) + "> [args...]")
+        sys.exit(1)
+    benchmarks[sys.argv[1]](*[int(arg) for arg in sys.argv[2:]])
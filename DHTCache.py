@@ -0,0 +1,58 @@
+# Zachary Garrett
+
+import threading
+from collections import OrderedDict
+from time import monotonic
+
+missing = object()  # Returned by get for keys that are not cached, since None can be a cached value
+
+
+# Bounded cache that drops the least recently used entry when it is full and ignores
+# entries older than ttl seconds. clear starts a new generation, so results of requests
+# sent before it can be told apart and are not cached
+class LRUCache:
+
+    def __init__(self, max_entries=1024, ttl=30):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.entries = OrderedDict()    # key -> (expiry, value), least recently used first
+        self.lock = threading.Lock()
+        self.generation = 0
+        self.hits = 0
+        self.misses = 0
+        self.clears = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    # Returns the value cached under key, or default if there is none or it expired
+    def get(self, key, default=missing):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[0] > monotonic():
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            if entry is not None:
+                del self.entries[key]
+            self.misses += 1
+            return default
+
+    # Caches value under key, unless the cache was cleared since generation was read
+    def put(self, key, value, generation=None):
+        with self.lock:
+            if self.max_entries <= 0 or generation is not None and generation != self.generation:
+                return
+            self.entries[key] = (monotonic() + self.ttl, value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.generation += 1
+            self.clears += 1
+
+    def stats(self):
+        return dict(hits=self.hits, misses=self.misses, clears=self.clears, entries=len(self.entries))
@@ -1,16 +1,62 @@
 # Zachary Garrett
 
 import socket
-import pickle
 import threading
+import selectors
 import logging
 import sys
+import atexit
+import random
+import itertools
+import collections
+import hashlib
+import os
+import DHTTransport
+import DHTCodec
+import DHTHash
+import DHTStorage
+import DHTCache
+import DHTIngest
+import DHTLock
+import multiprocessing
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
 from csv import reader
-from time import sleep
+from time import sleep, perf_counter, monotonic
 
 echo_max = 255  # Max echo size
 port_min = 26500  # Minimum allowed port
 port_max = 26999  # Maximum allowed port
+csv_path = 'StatsCountry.csv'   # File the leader loads on setup-dht
+key_column = "Long Name"    # Column that holds the key of a record (the leader's is used by the DHT)
+
+routing_mode = 'finger'  # How messages are forwarded: 'ring' (next node only), 'finger' or 'direct' (one hop)
+batch_store = True  # Load the csv in acked batches sent straight to each node instead of one store_row per record
+batch_bytes = 60000  # Payload budget of one migrate or scan_rows datagram (recvfrom reads at most 65535 bytes)
+lookup_timeout = 3  # Seconds a lookup waits for its reply
+lookup_poll = 0.25  # Longest the listener sleeps before checking for lookups that timed out
+mget_keys = 64  # Most keys asked of one node in a single mquery (keeps the reply inside one datagram)
+wire_format = 'binary'  # Encoding of sent messages: 'binary' (DHTCodec) or 'pickle' for peers without DHTCodec
+accept_pickle = False   # Also decode pickled messages. A pickle can run arbitrary code, trusted networks only
+hash_name = 'blake2b'   # Hash function for keys, one of DHTHash.hash_functions (the leader's is used by the DHT)
+placement = 'modulo'    # How keys map to nodes: 'modulo' (key hash % ring size) or 'consistent' (hash ring)
+vnodes = 64     # Points of every node on the consistent hash ring
+replicas = 1    # Nodes that store each record: its node and the replicas - 1 nodes after it (the leader's is used)
+migrate_window = 8  # Most migrate batches a node sends before waiting for the oldest one's ack
+migrate_tries = 3   # Times a migrate batch is sent before its records are kept on this node
+cache_entries = 1024    # Most query results a client keeps (0 turns caching off)
+cache_ttl = 30  # Seconds a cached query result is used, a DHT set up again with the same members is seen after it
+reliable_ring = True    # Send messages to left ports through DHTTransport's acked channel (resent until they arrive)
+transport = 'udp'   # How messages to left ports travel: 'udp' datagrams or 'tcp' (the leader's is used by the DHT)
+stream_batch_bytes = 1 << 20    # Payload budget of one batch over tcp, which has no datagram size limit
+read_batch = 64     # Most datagrams read from one port before the listener turns to the others
+query_workers = 4   # Threads that answer queries, so the listener keeps reading (0 answers them on the listener)
+receive_buffer = 1 << 20    # SO_RCVBUF of the left and query sockets in bytes (0 keeps the OS default)
+send_buffer = 0     # SO_SNDBUF of the left and query sockets in bytes (0 keeps the OS default)
+ingest_workers = 0  # Processes that parse and hash the csv on setup-dht (0 reads it on the listening client)
+storage = 'records'     # How a node keeps its rows, one of DHTStorage.stores: 'records' (an object per row), 'columns'
+snapshot_dir = 'snapshots'  # or 'snapshot' (memory-mapped files in snapshot_dir that outlive the process)
+snapshot = ''   # Digest of the members and settings the rows of this node were stored under
+indexed_columns = ()    # Columns each node indexes by value for scans, the key is always indexed in order
 
 identifier = -1
 ring_size = -1
@@ -21,58 +67,255 @@ port_query = -1
 
 next_addr = ('', 0)
 
-hash_table = [None] * 353
+hash_table = DHTStorage.new_store(storage, key_column, indexed_columns)
 leader = ''
 my_name = ''
 
 dht_addresses = []
-
-
-# Start threads to listen to the ports
+finger_table = []   # (distance, left address) shortcuts to the nodes 1, 2, 4, ... positions ahead
+known_addresses = []    # DHT membership last received from the server, used to query the owner directly
+hash_ring = (None, None, None)  # (members, (member names, vnodes), DHTHash.HashRing) last used for placement
+
+listening = False
+listen_thread = None
+query_pool = None   # ThreadPoolExecutor of the query_workers
+thread_role = threading.local()     # query_worker is set on the threads of query_pool
+state_lock = DHTLock.ReadWriteLock()    # Queries read under it, changes to the rows or the ring write under it
+pending_lookups = dict()    # request_id -> (future, deadline) of lookups waiting for their reply
+pending_lock = threading.Lock()
+pending_scans = dict()  # request_id -> rows and per node counts of scans waiting for their batches
+request_ids = itertools.count(1)
+node_load = collections.Counter()   # node name -> lookups this client has in flight to it
+migrate_lock = threading.Lock()    # One migration at a time, a newer membership waits for the running one
+result_cache = DHTCache.LRUCache(cache_entries, cache_ttl)  # long name -> record found in the DHT
+
+
+# Start thread to listen to the ports
 def start_listening(params, cmd_params):
-    global port_left, port_query, local_ip, my_name
+    global port_left, port_query, local_ip, my_name, listening, listen_thread, query_pool
 
     my_name = cmd_params[0]     # Save client nickname
     port_left = int(params["client_info"]["portl"])
     port_query = int(params["client_info"]["portq"])
     local_ip = params["client_info"]["ip"]
-    left_thread = threading.Thread(target=listen_left, args=(port_left,))  # Config thread that listens to left
-    query_thread = threading.Thread(target=listen_query, args=(port_query,))  # Config thread that listens to query
-    left_thread.start()  # Start thread
-    query_thread.start()  # Start thread
+    left_sock = bind_port(port_left)
+    query_sock = bind_port(port_query)
+    stream_sock = listen_port(port_left)
+    DHTTransport.open_sender(left_sock)    # Everything this node sends comes from its left port
+    if query_workers:
+        query_pool = ThreadPoolExecutor(query_workers, "query", initializer=mark_query_worker)
+    listening = True
+    listen_thread = threading.Thread(target=listen, args=(left_sock, query_sock, stream_sock))  # Listens to all three
+    listen_thread.start()  # Start thread
+
+
+# Stops the listener thread, which closes both ports
+def stop_listening():
+    global listening, query_pool
+    listening = False
+    if listen_thread is not None:
+        listen_thread.join()
+    if query_pool is not None:
+        query_pool.shutdown()
+        query_pool = None
+
+
+# Runs on every thread of query_pool as it starts
+def mark_query_worker():
+    thread_role.query_worker = True
+
+
+# False on the threads that must not wait for room to send: the listener reads the acks that
+# make room, and a query worker holds state_lock, which the listener may be waiting for
+def may_wait():
+    return threading.current_thread() is not listen_thread and not getattr(thread_role, "query_worker", False)
+
+
+# Establish socket and bind
+def bind_port(port):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    DHTTransport.size_buffers(sock, receive_buffer, send_buffer)
+    sock.bind(('', port))
+    sock.setblocking(False)
+    return sock
+
+
+# Listen for tcp connections of the stream transport on port. Every node accepts them, so the
+# leader can choose either transport for the DHT
+def listen_port(port):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind(('', port))
+    sock.listen(64)
+    sock.setblocking(False)
+    return sock
 
 
 # Setup the node
 def setup_node(params):
-    global next_addr, ring_size, identifier, dht_addresses
-
-    next_addr = params["next"]
-    ring_size = params["ring_size"]
-    identifier = params["identifier"]
-    dht_addresses = params["all_addresses"]
+    global next_addr, ring_size, identifier, dht_addresses, wire_format, hash_name, leader, placement, vnodes, replicas, \
+        key_column, snapshot, transport
+
+    with state_lock.writing():
+        previous = dht_addresses
+        next_addr = params["next"]
+        ring_size = params["ring_size"]
+        identifier = params["identifier"]
+        dht_addresses = params["all_addresses"]
+        wire_format = params.get("wire_format", wire_format)   # Use the leader's encoding for ring traffic
+        transport = params.get("transport", transport)     # and transport
+        hash_name = params.get("hash_name", hash_name)  # Records were placed with the leader's hash function
+        placement = params.get("placement", placement)
+        vnodes = params.get("vnodes", vnodes)
+        replicas = params.get("replicas", replicas)
+        key_column = params.get("key_column", key_column)
+        hash_table.key_column = key_column
+        leader = params.get("leader", leader)
+        snapshot = params.get("snapshot", "")
+        restored = open_snapshot()
+        build_finger_table()
+    invalidate_caches()
+    if "return_addr" in params:
+        send(dict(code="setup_ack", request_id=params["request_id"], records=len(hash_table), restored=restored,
+                  message="Late setup ack from " + my_name), params["return_addr"])
+
+    # Hand the records this node no longer stores to their new nodes. Runs on its own thread
+    # because it waits for acks, which this listener thread has to receive
+    if len(hash_table) and not restored:
+        threading.Thread(target=migrate_records, args=(None, previous)).start()
+
+
+# Maps this node's snapshot when rows are kept in one, returns True if it holds the rows of
+# the current snapshot digest and they do not have to be stored again
+def open_snapshot():
+    if storage != 'snapshot':
+        return False
+    return hash_table.open(os.path.join(snapshot_dir, my_name), snapshot)
+
+
+# Digest of the members, the settings that place rows and source, which is what the rows were
+# loaded from on setup-dht or the previous digest when the members change. The codec version
+# is in it too, so rows stored by a version that packed or placed them differently are not reused
+def snapshot_digest(members, source):
+    settings = (members, hash_name, placement, vnodes, replicas, key_column, source, DHTCodec.version)
+    return hashlib.blake2b(repr(settings).encode('utf-8'), digest_size=16).hexdigest()
+
+
+# Builds the finger table from the addresses of every node in the DHT
+def build_finger_table():
+    global finger_table
+    finger_table = []
+    if ring_size < 2 or len(dht_addresses) != ring_size:
+        return
+
+    distance = 1
+    while distance < ring_size:
+        finger = dht_addresses[(identifier + distance) % ring_size]
+        finger_table.append((distance, (finger[1], finger[2])))    # Finger's left port
+        distance *= 2
+
+
+# Picks the address to forward a message to so it gets closer to node_id
+def next_hop(node_id):
+    if routing_mode == 'direct' and 0 <= node_id < len(dht_addresses) == ring_size:
+        owner = dht_addresses[node_id]
+        return owner[1], owner[2]      # Owner's left port
+    if routing_mode in ('finger', 'direct') and finger_table:
+        distance = (node_id - identifier) % ring_size
+        for finger_distance, finger_addr in reversed(finger_table):
+            if finger_distance <= distance:
+                return finger_addr
+    return next_addr
+
+
+# Forwards a message towards the node that owns node_id, counting the hop
+def forward(params, node_id):
+    params["hops"] = params.get("hops", 0) + 1
+    send(params, next_hop(node_id), ring=True)
+
+
+# Hops next_hop takes to cover a distance along the ring
+def route_hops(distance):
+    if distance == 0:
+        return 0
+    if routing_mode == 'direct' and len(dht_addresses) == ring_size:
+        return 1
+    if routing_mode in ('finger', 'direct') and finger_table:
+        return bin(distance).count("1")     # One finger per power of two
+    return distance
+
+
+# Picks the replica of node_id's records that is the fewest hops away, at random among the closest
+def replica_target(node_id):
+    if replicas <= 1 or ring_size <= 1:
+        return node_id
+    candidates = [(node_id + i) % ring_size for i in range(min(replicas, ring_size))]
+    hops = [route_hops((candidate - identifier) % ring_size) for candidate in candidates]
+    return random.choice([candidate for candidate, cost in zip(candidates, hops) if cost == min(hops)])
+
+
+# True if this node stores copies of node_id's records. A node outside any DHT stores none
+def is_replica(node_id):
+    return ring_size > 0 and (identifier - node_id) % ring_size < replicas
+
+
+# Node that a store message for node_id's records goes to next: its node, then each replica in turn
+def store_target(node_id):
+    distance = (identifier - node_id) % ring_size
+    return (identifier + 1) % ring_size if distance < replicas else node_id
+
+
+# True if a replica after this node still needs node_id's records
+def more_replicas(node_id):
+    return (identifier - node_id) % ring_size + 1 < min(replicas, ring_size)
 
 
 # Decides if row should be stored in this node
-# If not, send it to the next node
+# If not, send it closer to the node it belongs to
 def handle_store_row(params):
     global identifier, hash_table, next_addr, ring_size
 
     row = params["data_row"]
     node_id = row["node_id"]
-    pos = row["pos"]
 
     # Should be stored in current DHT client
-    if node_id == identifier:
-        # print("Data record id (" + str(node_id) + ") matches! Storing record in hash table position " + str(pos))
-        row.pop("node_id")
-        row.pop("pos")
-        hash_table[pos] = row
+    if is_replica(node_id):
+        # print("Data record id (" + str(node_id) + ") matches! Storing record in hash table position " + str(row["pos"]))
+        save_row(dict(row))
+        if more_replicas(node_id):
+            forward(params, store_target(node_id))
 
-    # Should not be stored in current DHT client, send to the next one
+    # Should not be stored in current DHT client, send it closer to its node
     else:
         # print("\nData record id (" + str(node_id) + ") does not match this client's id (" + str(
-        #     identifier) + ")\nNow sending to client " + str(next_addr) + "...\n")
-        send(params, next_addr)
+        #     identifier) + ")\nNow sending to client " + str(next_hop(node_id)) + "...\n")
+        forward(params, node_id)
+
+
+# Saves a row in the hash table
+def save_row(row):
+    global hash_table
+    row.pop("node_id")
+    row.pop("key_hash")
+    row.pop("pos")
+    with state_lock.writing():
+        hash_table.put(row)
+
+
+# Stores the records of a migrate batch and acks them to the sender. A node that just
+# joined learns the key column of the DHT from the first batch it receives
+def handle_migrate(params):
+    global hash_table, key_column
+    header = params["header"]
+    rows = [dict(zip(header, DHTCodec.unpack_value(row))) for row in params["rows"]]
+    with state_lock.writing():
+        if "key_column" in params:
+            key_column = params["key_column"]
+            hash_table.key_column = key_column
+        for row in rows:
+            hash_table.put(row)
+    send(dict(code="migrate_ack", stored=len(params["rows"]), request_id=params["request_id"],
+              message="Late ack for " + str(len(params["rows"])) + " migrated records"), params["return_addr"])
 
 
 # Logs message
@@ -80,33 +323,205 @@ def log_message(params):
     print(params["message"] + "\n")
 
 
+# Hands a query reply to the lookup waiting for it, or logs it if nobody is waiting
+def finish_lookup(params):
+    with pending_lock:
+        pending = pending_lookups.pop(params.get("request_id"), None)
+    if pending is None:
+        log_message(params)
+    else:
+        pending[0].set_result(params)
+
+
+# Fails lookups whose reply did not arrive in time, returns the seconds until the next deadline
+def expire_lookups():
+    now = monotonic()
+    expired = []
+    with pending_lock:
+        next_deadline = now + lookup_poll
+        for request_id, (future, deadline) in list(pending_lookups.items()):
+            if deadline <= now:
+                expired.append(pending_lookups.pop(request_id)[0])
+            else:
+                next_deadline = min(next_deadline, deadline)
+    for future in expired:
+        future.set_exception(TimeoutError("No reply to the query"))
+    return next_deadline - now
+
+
 # Decides if query can be handled by current node
 def check_query_status(params):
     global identifier, next_addr, hash_table
 
+    # This client left the DHT (or was never in one) and has nowhere to send the query
+    if ring_size <= 0:
+        return_msg = dict(code="query_failed", long_name=params["long_name"], hops=params.get("hops", 0),
+                          replica=my_name, stale=True, message="Query for '" + params["long_name"] + "' reached " + my_name +
+                                                   ", which is not in a DHT")
+        if "request_id" in params:
+            return_msg["request_id"] = params["request_id"]
+        send(return_msg, params["return_addr"], msg_format=params.get("reply_format"))
+        return
+
+    # Place the key again with this node's membership, since the sender's may be outdated in a way
+    # the ring size does not show (under consistent placement the owner depends on the member names)
+    params.update(hash_key(params["long_name"]))
+    params["ring_size"] = ring_size
+    params["hash_name"] = hash_name
+    params["placement"] = placement
+
+    # Any replica that has the record can answer, the record's own node answers either way
+    record = hash_table.get(params["long_name"]) if is_replica(params["node_id"]) else None
+
     # Current DHT Client can handle the query
-    if params["node_id"] == identifier:
+    if params["node_id"] == identifier or record is not None:
         print("\nQuery identifier ("+str(identifier)+") matches!")
         return_msg = dict()
+        return_msg["hops"] = params.get("hops", 0)
+        return_msg["long_name"] = params["long_name"]
+        return_msg["replica"] = my_name
+        if "request_id" in params:
+            return_msg["request_id"] = params["request_id"]
 
         # Record exists in hash table
-        if hash_table[params["pos"]] is not None:
+        if record is not None:
             print("Hash table has found a record in Position " + str(params["pos"]) + "! Sending record...")
             return_msg["code"] = "query_success"
-            return_msg["message"] = "Data Record for " + params["long_name"] + ":\n" + str(hash_table[params["pos"]])
+            return_msg["record"] = record
+            return_msg["message"] = "Data Record for " + params["long_name"] + ":\n" + str(record)
 
         # Record does not exist in hash table
         else:
-            print("Hash table does not contain any records in Position " + str(params["pos"]) + "\n")
+            print("Hash table does not contain a record for '" + params["long_name"] + "' in Position " + str(
+                params["pos"]) + "\n")
             return_msg["code"] = "query_failed"
             return_msg["message"] = "Record associated with '" + params["long_name"] + "' is not found in DHT"
-        send(return_msg, params["return_addr"])
+        return_msg["message"] += "\n(Resolved in " + str(return_msg["hops"]) + " hops)"
+        send(return_msg, params["return_addr"], msg_format=params.get("reply_format"))
 
-    # Send to next DHT client
+    # Replica without a copy yet, ask the record's own node
+    elif is_replica(params["node_id"]):
+        forward(params, params["node_id"])
+
+    # Send closer to the DHT client that owns the record
     else:
+        target = replica_target(params["node_id"])
         print("\nQuery record id (" + str(params["node_id"]) + ") does not match this client's id (" + str(
-            identifier) + ")\nNow sending to client " + str(next_addr) + "...\n")
-        send(params, next_addr)
+            identifier) + ")\nNow sending to client " + str(next_hop(target)) + "...\n")
+        forward(params, target)
+
+
+# True if a multi-key query was hashed differently than the records of this DHT, or any of its
+# keys is placed on another node by this node's membership (which can change without changing size)
+def stale_hash(params):
+    if ring_size <= 0:
+        return False
+    return params.get("ring_size", ring_size) != ring_size or params.get("hash_name", hash_name) != hash_name or \
+        params.get("placement", placement) != placement or \
+        any(hash_key(long_name)["node_id"] != params["node_id"] for long_name, pos in params["keys"])
+
+
+# Answers the keys of a multi-key query if this node owns them, otherwise passes the query on
+def check_mquery_status(params):
+    global identifier, hash_table
+
+    # This client left the DHT (or was never in one), the sender sends the keys again through the ring
+    if ring_size <= 0:
+        send(dict(code="mquery_success", stale=True, keys=params["keys"], request_id=params["request_id"],
+                  message="Multi-key query reached " + my_name + ", which is not in a DHT"), params["return_addr"],
+             msg_format=params.get("reply_format"))
+
+    # Sender grouped the keys with another hash function or an outdated membership, let it regroup them
+    elif stale_hash(params):
+        return_msg = dict(code="mquery_success", stale=True, ring_size=ring_size, hash_name=hash_name,
+                          placement=placement, vnodes=vnodes, tuples=dht_addresses, keys=params["keys"], request_id=params["request_id"],
+                          message="Multi-key query was hashed differently than this DHT")
+        send(return_msg, params["return_addr"], msg_format=params.get("reply_format"))
+
+    # Current DHT Client owns every key of the query, or is a replica that has them all
+    elif params["node_id"] == identifier or is_replica(params["node_id"]) and all(
+            long_name in hash_table for long_name, pos in params["keys"]):
+        records = dict()
+        for long_name, pos in params["keys"]:
+            records[long_name] = hash_table.get(long_name)
+        return_msg = dict(code="mquery_success", records=records, hops=params.get("hops", 0),
+                          request_id=params["request_id"],
+                          message="Found " + str(sum(record is not None for record in records.values())) + " of " +
+                                  str(len(records)) + " records")
+        send(return_msg, params["return_addr"], msg_format=params.get("reply_format"))
+
+    # Replica without every copy, ask the keys' own node
+    elif is_replica(params["node_id"]):
+        forward(params, params["node_id"])
+
+    # Send closer to the DHT client that owns the keys
+    else:
+        forward(params, replica_target(params["node_id"]))
+
+
+# Sends the rows of this node that match a scan to the requester's query port in batches,
+# the last one carrying how many matched, then passes the scan on until it has been to every
+# node of the ring once. Rows of a replica are sent too, the requester keeps one per key
+def handle_scan(params):
+    keys = hash_table.scan(params.get("prefix"), params.get("start"), params.get("end"), params.get("column"),
+                           params.get("value"))
+    batch = None
+    size = 0
+    for key in keys:
+        row = hash_table.get(key)
+        if row is None:
+            continue
+        header = list(row)
+        packed = DHTCodec.pack_value(list(row.values()))
+        if batch is not None and (batch["header"] != header or size + len(packed) + 16 > batch_bytes):
+            send(batch, params["return_addr"], msg_format=params.get("reply_format"))
+            batch = None
+        if batch is None:
+            batch = dict(code="scan_rows", request_id=params["request_id"], header=header, rows=[], node=my_name,
+                         last=False)
+            size = 0
+        batch["rows"].append(packed)
+        size += len(packed) + 16
+    if batch is None:
+        batch = dict(code="scan_rows", request_id=params["request_id"], header=[], rows=[], node=my_name)
+    batch.update(last=True, matched=len(keys), ring_size=ring_size, key_column=key_column)
+    send(batch, params["return_addr"], msg_format=params.get("reply_format"))
+
+    hops = params.get("hops", 0) + 1
+    if hops < ring_size:
+        params["hops"] = hops
+        send(params, next_addr, ring=True)
+
+
+# Adds a batch of rows to the scan waiting for it, which is done once every node of the ring
+# sent its last batch and all the rows it matched arrived. Each batch gives the scan another
+# timeout seconds, so a long scan only fails if its rows stop coming
+def collect_scan_rows(params):
+    header = params["header"]
+    rows = [dict(zip(header, DHTCodec.unpack_value(packed))) for packed in params["rows"]]
+    request_id = params.get("request_id")
+    with pending_lock:
+        scan = pending_scans.get(request_id)
+        if scan is None or request_id not in pending_lookups:
+            return
+        future = pending_lookups[request_id][0]
+        pending_lookups[request_id] = (future, monotonic() + scan["timeout"])
+        scan["rows"].extend(rows)
+        counts = scan["nodes"].setdefault(params["node"], [0, None])     # rows received, rows matched
+        counts[0] += len(rows)
+        if params.get("last"):
+            counts[1] = params["matched"]
+            scan["ring_size"] = params["ring_size"]
+            scan["key_column"] = params["key_column"]
+        if scan["ring_size"] is None or sum(received >= matched for received, matched in scan["nodes"].values()
+                                            if matched is not None) < scan["ring_size"]:
+            return
+        del pending_lookups[request_id]
+        del pending_scans[request_id]
+
+    # One row per key, the rows of replicas are the same
+    unique = dict((row[scan["key_column"]], row) for row in scan["rows"])
+    future.set_result([unique[key] for key in sorted(unique)])
 
 
 # Removes current node's dht info and then passes on teardown to the next node
@@ -115,24 +530,32 @@ def teardown_dht(params):
 
     if leader == my_name:
         print("\nI am the leader. Deleting DHT information...")
-        reset_dht_globals()
+        reset_dht_globals(True)
         print("Confirming teardown-complete with the server...")
         send("teardown-complete " + str(my_name), params["serverAddr"], True)
         print("Teardown confirmed.")
     else:
         print("\nTeardown DHT --> Deleting DHT information...")
-        send(params, next_addr)     # Pass 'teardown' to next node
-        reset_dht_globals()
+        send(params, next_addr, ring=True)  # Pass 'teardown' to next node
+        reset_dht_globals(True)
         print("Successfully deleted local DHT info.")
 
 
-# Reset global DHT values
-def reset_dht_globals():
-    global leader, my_name, next_addr, ring_size, identifier
-    leader = ''  # Remove all dht information
-    ring_size = -1
-    identifier = -1
-    next_addr = ('', 0)
+# Reset global DHT values. A torn down DHT keeps its snapshots for the next setup-dht
+def reset_dht_globals(keep_snapshot=False, keep_rows=False):
+    global leader, my_name, next_addr, ring_size, identifier, finger_table, dht_addresses
+    with state_lock.writing():
+        leader = ''  # Remove all dht information
+        ring_size = -1
+        identifier = -1
+        next_addr = ('', 0)
+        finger_table = []
+        dht_addresses = []
+        if keep_snapshot and storage == 'snapshot':
+            hash_table.close()
+        elif not keep_rows:
+            hash_table.clear()
+    invalidate_caches()
 
 
 
@@ -141,7 +564,9 @@ def leave_dht(params):
 
     print("BEFORE")
     print(dht_addresses)
-    dht_addresses = params["tuples"]
+    previous = dht_addresses
+    with state_lock.writing():
+        dht_addresses = params["tuples"]
 
     # if identifier == len(dht_addresses) - 1:
     #     dht_addresses = dht_addresses[:identifier]
@@ -154,7 +579,7 @@ def leave_dht(params):
     print(dht_addresses)
 
     params["dht_size"] = len(dht_addresses)
-    config_dht_users(params, [])
+    config_dht_users(params, [], previous)
 
     send("dht-rebuilt " + str(params["original"]) + " " + str(dht_addresses[0][0]), params["serverAddr"], True)
 
@@ -164,177 +589,590 @@ left_handler = dict(
     setup=setup_node,
     store_row=handle_store_row,
     query=check_query_status,
+    mquery=check_mquery_status,
     teardown=teardown_dht,
-    leave=leave_dht
+    leave=leave_dht,
+    migrate=handle_migrate,
+    scan=handle_scan
 )
 
 
-# Listens to specified port in infinite loop
-def listen_left(port):
-    # Establish socket and bind
-    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-    sock.bind(('', port))
-    sock.setblocking(False)
-
-    while True:
-        try:
-            msg, from_addr = sock.recvfrom(65535)
-
-            if msg is not None:
-                params = pickle.loads(msg)
-
-                # Call instructions based on code
-                if params["code"] in left_handler:
-                    left_handler[params["code"]](params)
-        # Nonblocking error
-        except socket.timeout as e:
-            err = e.args[0]
-            if err == 'timed out':
-                sleep(1)
-                continue
-            else:
-                print(e)
-                sys.exit(1)
-        # Other error has occurred
-        except socket.error as e:
-            sleep(1)
-            continue
-            # print(e)
-            # sys.exit(1)
-
+query_handlers = (check_query_status, check_mquery_status, handle_scan)  # Handlers that only read the node state
 
 # Handles incoming requests for query port
 query_handler = dict(
     query=check_query_status,
-    query_success=log_message,
-    query_failed=log_message
+    mquery=check_mquery_status,
+    query_success=finish_lookup,
+    query_failed=finish_lookup,
+    mquery_success=finish_lookup,
+    migrate_ack=finish_lookup,
+    setup_ack=finish_lookup,
+    scan=handle_scan,
+    scan_rows=collect_scan_rows
 )
 
 
-# Listens to query port
-def listen_query(port):
-    # Establish socket and bind
-    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-    sock.bind(('', port))
-    sock.setblocking(False)
+# Waits on the left and query ports and the tcp connections to the left port, and handles
+# each message as soon as it arrives
+def listen(left_sock, query_sock, stream_sock):
+    selector = selectors.DefaultSelector()
+    selector.register(left_sock, selectors.EVENT_READ, left_handler)
+    selector.register(query_sock, selectors.EVENT_READ, query_handler)
+    selector.register(stream_sock, selectors.EVENT_READ)
+
+    while listening:
+        timeout = expire_lookups()
+        retransmit = DHTTransport.retransmit()
+        for key, events in selector.select(timeout if retransmit is None else min(timeout, retransmit)):
+            if key.fileobj is stream_sock:
+                accept_stream(stream_sock, selector)
+            elif isinstance(key.data, DHTTransport.StreamReader):
+                if not receive_stream(key.fileobj, key.data):
+                    selector.unregister(key.fileobj)
+                    key.fileobj.close()
+            else:
+                receive(key.fileobj, key.data)
 
-    while True:
+    for key in list(selector.get_map().values()):
+        key.fileobj.close()
+    selector.close()
+
+
+# Handles up to read_batch messages waiting on sock with the given handlers, then acks the
+# ring messages among them. The listener then waits on every port again, so a flood of rows
+# on the left port does not hold off the queries on the query port
+def receive(sock, handlers):
+    for i in range(read_batch):
         try:
-            msg, from_addr = sock.recvfrom(65535)
-
-            if msg is not None:
-                params = pickle.loads(msg)
-
-                # Call instructions based on code
-                if params["code"] in query_handler:
-                    query_handler[params["code"]](params)
-        # Nonblocking error
-        except socket.timeout as e:
-            err = e.args[0]
-            if err == 'timed out':
-                sleep(1)
-                continue
-            else:
-                print(e)
-                sys.exit(1)
-        # Other error has occurred
-        except socket.error as e:
-            sleep(1)
+            data, from_addr = sock.recvfrom(65535)
+        # Nothing left to read
+        except BlockingIOError:
+            break
+        # Other error has occurred (e.g. ICMP port unreachable reported on the socket)
+        except socket.error:
             continue
-            # print(e)
-            # sys.exit(1)
 
+        for msg in DHTTransport.accept(data, from_addr):
+            handle_message(msg, from_addr, handlers)
+    DHTTransport.flush_acks()
 
-# Send message to the right
-def send(content, path_info, str_val=False):
+
+# Takes a tcp connection to the left port and waits for its messages with the others
+def accept_stream(stream_sock, selector):
+    try:
+        sock, from_addr = stream_sock.accept()
+    except (BlockingIOError, socket.error):
+        return
+    sock.setblocking(False)
+    selector.register(sock, selectors.EVENT_READ, DHTTransport.StreamReader(from_addr))
+
+
+# Handles the messages that arrived on a tcp connection, False once the peer closed it
+def receive_stream(sock, reader):
+    messages = reader.read(sock)
+    if messages is None:
+        return False
+    for msg in messages:
+        handle_message(msg, reader.peer, left_handler)
+    return True
+
+
+# Decodes a message and calls the handler of its code. Queries are handed to query_pool
+def handle_message(msg, from_addr, handlers):
+    try:
+        params = DHTCodec.decode(msg, accept_pickle or wire_format == 'pickle')
+
+        # Call instructions based on code
+        if isinstance(params, dict) and params.get("code") in handlers:
+            handler = handlers[params["code"]]
+
+            # Queries are answered in the encoding their sender used, kept as they are forwarded
+            if handler in query_handlers and not params.get("reply_format"):
+                params["reply_format"] = 'pickle' if msg[:1] == b'\x80' else 'binary'
+            if handler in query_handlers and query_pool is not None:
+                query_pool.submit(answer_query, handler, params, from_addr)
+            elif handler in query_handlers:
+                answer_query(handler, params, from_addr)
+            else:
+                handler(params)
+    except Exception as e:
+        print("Could not handle message from " + str(from_addr) + ": " + repr(e))
+
+
+# Runs a query handler with the node state locked for reading, so the rows, the ring and
+# the hash settings it sees do not change under it
+def answer_query(handler, params, from_addr):
+    try:
+        with state_lock.reading():
+            handler(params)
+    except Exception as e:
+        print("Could not handle message from " + str(from_addr) + ": " + repr(e))
+
+
+# Send message to the right. Ring messages (to a node's left port) go over a tcp connection
+# when transport is 'tcp', or are resent until acked when reliable_ring is set. The listener
+# thread and the query workers do not wait for room in the window or the connection's queue.
+# msg_format overrides wire_format, for replies to a client that uses another encoding
+def send(content, path_info, str_val=False, ring=False, msg_format=None):
     path_info = (path_info[0], int(path_info[1]))
 
     if str_val:
         send_msg = content.encode('utf-8')
     else:
-        send_msg = pickle.dumps(content)
-
-    # Establish socket
-    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        send_msg = DHTCodec.encode(content, msg_format or wire_format)
 
     # Send
-    sock.sendto(send_msg, path_info)
+    if ring and transport == 'tcp':
+        DHTTransport.send_stream(send_msg, path_info, may_wait())
+    elif ring and reliable_ring:
+        DHTTransport.send_reliable(send_msg, path_info, may_wait())
+    else:
+        DHTTransport.send_bytes(send_msg, path_info)
 
 
-# Leader sends each client their mapping to the next client in the path
-def config_dht_users(params, cmd_params):
-    global next_addr, identifier, ring_size, leader, dht_addresses
+# Sends each client their mapping to the next client in the path. Run by the leader on
+# setup-dht, which loads the csv, and by the client that rebuilds the DHT after a join
+# or leave with the previous membership, where every node migrates its records instead
+def config_dht_users(params, cmd_params, previous=None):
+    global next_addr, identifier, ring_size, leader, dht_addresses, snapshot
 
     client_addresses = params["tuples"]
-    dht_addresses = client_addresses
     leader_name = client_addresses[0][0]
-    leader = leader_name
+    with state_lock.writing():
+        dht_addresses = client_addresses
+        leader = leader_name
+        ring_size = params["dht_size"]
+        hash_table.key_column = key_column
+        snapshot = snapshot_digest(dht_addresses, csv_source() if previous is None else snapshot)
+        restored = open_snapshot()
+    invalidate_caches()
 
     # print("Client Addresses")
     # print(client_addresses)
-    next_addr = (client_addresses[1][1], client_addresses[1][2])  # Set leader's next address
-    identifier = 0  # Set leader's identifier
-    ring_size = params["dht_size"]
+    names = [address[0] for address in client_addresses]
+    me = names.index(my_name) if my_name in names else 0   # The client running this is not always the leader
+    joining = previous is not None and my_name not in [address[0] for address in previous]
+    acks = []   # Replies to setup, which tell if the node still has its rows from a snapshot
 
     # Send each DHT client their pathing for the DHT cycle
-    for i in range(1, len(client_addresses)):
+    for i in range(len(client_addresses)):
+        following = client_addresses[(i + 1) % len(client_addresses)]
+        send_addr = (following[1], following[2])    # Sends to client left port
+        if i == me:
+            with state_lock.writing():
+                next_addr = send_addr
+                identifier = i
+                build_finger_table()
+            continue
         receiver = (client_addresses[i][1], client_addresses[i][2])
-        if i == len(client_addresses) - 1:
-            send_addr = (client_addresses[0][1], client_addresses[0][2])    # Sends to client left port
+        data = dict(code="setup", next=send_addr, ring_size=params["dht_size"], identifier=i, all_addresses=dht_addresses,
+                    wire_format=wire_format, hash_name=hash_name, leader=leader_name, placement=placement,
+                    vnodes=vnodes, replicas=replicas, key_column=key_column, snapshot=snapshot, transport=transport)
+        if joining:
+            del data["key_column"]  # A joining client learns the key column from the records migrated to it
+        if previous is None:
+            data.update(request_id=next(request_ids), return_addr=(local_ip, port_query))
+            acks.append(send_lookup(data, receiver, ring=True))
         else:
-            send_addr = (client_addresses[i + 1][1], client_addresses[i + 1][2])    # Sends to client left port
-        data = dict(code="setup", next=send_addr, ring_size=params["dht_size"], identifier=i, all_addresses=dht_addresses)
-        send(data, receiver)
+            send(data, receiver, ring=True)
 
-    store_data()
+    if previous is not None:
+        threading.Thread(target=migrate_records, args=(None, previous)).start()    # leave_dht runs on the listener
+    elif restored and all(setup_acked(ack) for ack in acks):
+        print("Restored " + str(sum(ack.result()["records"] for ack in acks) + len(hash_table)) +
+              " records from the snapshots of an unchanged DHT")
+    else:
+        store_data()
     print(params["message"])
     send("dht-complete " + leader_name, params["serverAddr"], True)
 
 
-# Stores csv data into the DHT
-def store_data():
-    global next_addr
-    data = read_from_csv()
-    for row in data:
-        inputs = dict(code="store_row", data_row=row)
-        send(inputs, next_addr)
-
-
-# Reads csv into list
-def read_from_csv():
-    data = []
-    with open('StatsCountry.csv', 'r', encoding='utf-8', errors='ignore') as read_obj:
+# True if the node that sent the setup ack restored its rows from its snapshot
+def setup_acked(ack):
+    try:
+        return ack.result()["restored"]
+    except TimeoutError:
+        return False
+
+
+# What setup-dht loads the rows from: the csv's path, size and modification time
+def csv_source():
+    info = os.stat(csv_path)
+    return os.path.abspath(csv_path), info.st_size, info.st_mtime_ns
+
+
+# Stores the csv at path (csv_path by default) into the DHT
+def store_data(path=None):
+    stats = store_parallel(path) if ingest_workers and batch_store else store_rows(read_from_csv(path))
+    print("Stored " + str(stats["rows"]) + " records in " + "%.3f" % stats["seconds"] + "s (" + "%.0f" % (
+        stats["rows"] / max(stats["seconds"], 1e-9)) + " rows/sec)" +
+        ("" if not stats["unacked"] else ", " + str(stats["unacked"]) + " rows were not acked"))
+    print_transport_stats()
+    return stats
+
+
+# Stores rows from read_from_csv into the DHT as they come. Batched rows are packed into a
+# bucket per node and every full bucket is sent straight to its node in an acked migrate
+# batch, so memory holds a bucket per node and the unacked batches however long rows is,
+# and rows are only read as fast as the nodes ack them. Returns the number of rows, the
+# number whose batch was never acked and the seconds until the first batch and in total
+def store_rows(rows):
+    start = perf_counter()
+    stats = dict(rows=0, unacked=0, first_batch=None)
+    if batch_store:
+        acked, stats["unacked"] = send_migrations(bucket_rows(rows, stats, start))
+    else:
+        for row in rows:
+            stats["rows"] += 1
+            inputs = dict(code="store_row", data_row=row)
+            handle_store_row(inputs)    # Keeps the row or routes it towards its node
+    stats["seconds"] = perf_counter() - start
+    return stats
+
+
+# Stores the csv at path into the DHT with ingest_workers processes that each parse and hash
+# byte ranges of it. The rows come back grouped by node and are sent in acked migrate batches
+# like store_rows does, with at most two ranges per worker parsed ahead of the sending.
+# Returns the same stats as store_rows
+def store_parallel(path=None):
+    start = perf_counter()
+    stats = dict(rows=0, unacked=0, first_batch=None)
+    acked, stats["unacked"] = send_migrations(parallel_batches(path or csv_path, stats, start))
+    stats["seconds"] = perf_counter() - start
+    return stats
+
+
+# Yields the migrate batches of the rows parsed by the worker processes, storing the rows of
+# this node right away. Workers are spawned since the listener thread is already running
+def parallel_batches(path, stats, start):
+    members = dht_addresses
+    header, ranges = DHTIngest.split_file(path)
+    settings = dict(key_column=key_column, hash_name=hash_name, placement=placement, vnodes=vnodes,
+                    names=tuple(member[0] for member in members))
+    with ProcessPoolExecutor(ingest_workers, multiprocessing.get_context('spawn')) as pool:
+        ranges = iter(ranges)
+        running = collections.deque()
+        while True:
+            while len(running) < 2 * ingest_workers:
+                byte_range = next(ranges, None)
+                if byte_range is None:
+                    break
+                running.append(pool.submit(DHTIngest.partition_chunk, path, *byte_range, header, settings))
+            if not running:
+                return
+            for node_id, (rows, keys) in running.popleft().result().items():
+                stats["rows"] += len(rows)
+                for node in replica_nodes(node_id, members):
+                    if node[0] == my_name:
+                        own = [dict(zip(header, DHTCodec.unpack_value(row))) for row in rows]
+                        with state_lock.writing():
+                            for row in own:
+                                hash_table.put(row)
+                        continue
+                    for batch in pack_batches((node[1], node[2]), header, rows, keys):
+                        if stats["first_batch"] is None:
+                            stats["first_batch"] = perf_counter() - start
+                        yield batch
+
+
+# Payload budget of one batch of rows: a datagram holds at most 65535 bytes, a tcp message any number
+def batch_limit():
+    return stream_batch_bytes if transport == 'tcp' else batch_bytes
+
+
+# Splits packed rows bound for the node at addr into batches of at most batch_limit() bytes
+def pack_batches(addr, header, rows, keys):
+    batch = None
+    for packed, key in zip(rows, keys):
+        if batch is not None and batch["size"] + len(packed) + 16 > batch_limit():
+            yield batch
+            batch = None
+        if batch is None:
+            batch = dict(addr=addr, header=header, rows=[], long_names=[], size=0)
+        batch["rows"].append(packed)
+        batch["long_names"].append(key)
+        batch["size"] += len(packed) + 16
+    if batch is not None:
+        yield batch
+
+
+# Packs rows into a bucket for every node that stores them and yields each bucket once it is
+# full, then the ones left partly filled. Rows of this node are stored right away
+def bucket_rows(rows, stats, start):
+    buckets = dict()    # left address -> batch being filled
+    header = None
+    for row in rows:
+        stats["rows"] += 1
+        if header is None:
+            header = [column for column in row if column not in ("pos", "node_id", "key_hash")]
+        values = [row[column] for column in header]
+        packed = None
+        for node in replica_nodes(row["node_id"], dht_addresses):
+            if node[0] == my_name:
+                with state_lock.writing():
+                    hash_table.put(dict(zip(header, values)))
+                continue
+            if packed is None:
+                packed = DHTCodec.pack_value(values)
+            addr = (node[1], node[2])
+            batch = buckets.get(addr)
+            if batch is not None and batch["size"] + len(packed) + 16 > batch_limit():
+                if stats["first_batch"] is None:
+                    stats["first_batch"] = perf_counter() - start
+                yield buckets.pop(addr)
+                batch = None
+            if batch is None:
+                batch = buckets[addr] = dict(addr=addr, header=header, rows=[], long_names=[], size=0)
+            batch["rows"].append(packed)
+            batch["long_names"].append(row[key_column])
+            batch["size"] += len(packed) + 16
+
+    if buckets and stats["first_batch"] is None:
+        stats["first_batch"] = perf_counter() - start
+    for batch in buckets.values():
+        yield batch
+
+
+# Sends the records that members stores on other nodes straight to those nodes, in acked
+# batches, and removes them here once every node acked them. A record this node keeps is
+# copied to the nodes that did not store it in the previous membership, if this node is
+# the first one that did. members defaults to the current DHT. Returns the number of records
+# that were not acked and stay on this node
+def migrate_records(members=None, previous=None):
+    with migrate_lock:
+        start = perf_counter()
+        if members is None:
+            members = dht_addresses
+        if not members:
+            return 0
+
+        # Group the records to send by the left port of each node that needs them
+        moving = dict()
+        remaining = collections.Counter()   # long name -> nodes that still have to ack it before it is removed
+        copies = 0
+        with state_lock.reading():
+            long_names = list(hash_table.keys())
+        for long_name in long_names:
+            nodes = replica_nodes(hash_key(long_name, members)["node_id"], members)
+            names = [node[0] for node in nodes]
+            if my_name not in names:
+                remaining[long_name] = len(nodes)
+            elif previous:
+                old = replica_nodes(hash_key(long_name, previous)["node_id"], previous)
+                old_names = [node[0] for node in old]
+                keepers = [name for name in names if name in old_names]
+                if not keepers or keepers[0] != my_name:
+                    continue
+                nodes = [node for node in nodes if node[0] not in old_names]
+                copies += len(nodes)
+            else:
+                continue
+            for node in nodes:
+                moving.setdefault((node[1], node[2]), []).append(long_name)
+
+        # Take turns between the nodes so the unacked batches are spread over their receive buffers
+        per_node = [migrate_batches(addr, long_names) for addr, long_names in moving.items()]
+        batches = [batch for turn in itertools.zip_longest(*per_node) for batch in turn if batch is not None]
+        send_migrations(batches, remaining)
+        moved = sum(1 for count in remaining.values() if count == 0)
+        kept = len(remaining) - moved
+
+        elapsed = perf_counter() - start
+        print("Migrated " + str(moved) + " records and " + str(copies) + " copies to " + str(len(moving)) +
+              " nodes in " + "%.3f" % elapsed + "s" +
+              ("" if not kept else ", " + str(kept) + " records were not acked and stay on this node"))
+        return kept
+
+
+# Member tuples of the nodes that store node_id's records, its own node first
+def replica_nodes(node_id, members):
+    return [members[(node_id + i) % len(members)] for i in range(min(replicas, len(members)))]
+
+
+# Packs the records of long_names into size-bounded batches for the node at addr
+def migrate_batches(addr, long_names):
+    batches = []
+    batch = None
+    for long_name in long_names:
+        with state_lock.reading():
+            record = hash_table.get(long_name)
+        if record is None:
+            continue
+        row = DHTCodec.pack_value(list(record.values()))
+        if batch is None or batch["size"] + len(row) + 16 > batch_limit() or batch["header"] != list(record):
+            batch = dict(addr=addr, header=list(record), rows=[], long_names=[], size=0)
+            batches.append(batch)
+        batch["rows"].append(row)
+        batch["long_names"].append(long_name)
+        batch["size"] += len(row) + 16
+    return batches
+
+
+# Sends migrate batches with at most migrate_window unacked at a time and resends the ones
+# that time out. The next batch is only taken from batches when there is room in the window.
+# remaining counts the acks each moving record still needs before it is removed here.
+# Returns the number of rows acked and the number that never were
+def send_migrations(batches, remaining=None):
+    acked = 0
+    unacked = 0
+    batches = iter(batches)
+    retries = collections.deque()
+    in_flight = collections.deque()
+    while True:
+        while len(in_flight) < migrate_window:
+            if retries:
+                batch, tries = retries.popleft()
+            else:
+                batch, tries = next(batches, None), 1
+                if batch is None:
+                    break
+            message = dict(code="migrate", header=batch["header"], rows=batch["rows"], request_id=next(request_ids),
+                           return_addr=(local_ip, port_query), key_column=key_column)
+            in_flight.append((send_lookup(message, batch["addr"], ring=True), batch, tries))
+        if not in_flight:
+            return acked, unacked
+
+        future, batch, tries = in_flight.popleft()
+        try:
+            future.result()
+        except TimeoutError:
+            if tries < migrate_tries:
+                retries.append((batch, tries + 1))
+            else:
+                unacked += len(batch["rows"])
+            continue
+        acked += len(batch["rows"])
+        if remaining is not None:
+            for long_name in batch["long_names"]:
+                if long_name in remaining:
+                    remaining[long_name] -= 1
+                    if remaining[long_name] == 0:
+                        with state_lock.writing():
+                            hash_table.remove(long_name)
+
+
+# Reads the csv at path (csv_path by default) one row at a time, yielding each row as a
+# dict of column -> value plus its pos, node_id and key_hash
+def read_from_csv(path=None):
+    with open(path or csv_path, 'r', encoding='utf-8', errors='ignore', newline='') as read_obj:
         csv_reader = reader(read_obj)
         header = next(csv_reader)
         for row in csv_reader:
-            assoc_row = dict()
-            for i in range(len(header)):
-                assoc_row[header[i]] = row[i]  # Make associative
-            hash_vals = compute_hash(assoc_row)  # Compute hash
-            assoc_row["pos"] = hash_vals["pos"]
-            assoc_row["node_id"] = hash_vals["node_id"]
-            data.append(assoc_row)  # Add to data list
-    return data
-
-
-# Computes the hash function
-def compute_hash(row):
-    long_name = row["Long Name"]
-    total_ascii = 0
-    for letter in long_name:
-        total_ascii += ord(letter)
-    pos = total_ascii % 353  # Compute pos
-    node_id = pos % ring_size  # Compute node identifier
-    return dict(pos=pos, node_id=node_id)
+            assoc_row = dict(zip(header, row))  # Make associative
+            assoc_row.update(compute_hash(assoc_row))   # Compute hash
+            yield assoc_row
+
+
+# Computes the hash function of a row, members is the DHT membership to place the key in
+def compute_hash(row, members=None):
+    return hash_key(row[key_column], members)
+
+
+# Computes the hash function of a key
+def hash_key(key, members=None):
+    if members is None:
+        members = dht_addresses
+    key_hash = DHTHash.hash_functions[hash_name](key)
+    pos = key_hash % DHTHash.table_size  # Compute pos, only shown in logs
+    node_id = place(key_hash, members)  # Compute node identifier
+    return dict(pos=pos, node_id=node_id, key_hash=key_hash)
+
+
+# Computes the node identifier of the member that owns a key
+def place(key_hash, members):
+    global hash_ring
+    if not members:
+        return key_hash % ring_size
+    if placement != 'consistent':
+        return key_hash % len(members)  # The whole hash, so nodes are not limited to table_size slots
+
+    ring = hash_ring
+    if ring[0] is not members or ring[1][1] != vnodes:
+        layout = (tuple(member[0] for member in members), vnodes)
+        ring = (members, layout, ring[2] if ring[1] == layout else DHTHash.HashRing(layout[0], vnodes))
+        hash_ring = ring
+    return ring[2].owner(key_hash)
 
 
 # Sends query to client in DHT
 def submit_query(params, cmd_params):
-    global port_query, local_ip
     long_name = input("Enter long name to query: ")
-    hash_input = dict()
-    hash_input["Long Name"] = long_name
-    hash_output = compute_hash(hash_input)
+
+    # Cache the DHT membership sent by the server
+    if "tuples" in params:
+        adopt_membership(params["tuples"])
+
+    # Send query and wait for the reply
+    future = lookup(long_name, (params["tuple"][1], params["tuple"][3]))
+    try:
+        log_message(future.result())
+    except TimeoutError:
+        print("No reply for '" + long_name + "' within " + str(lookup_timeout) + " seconds\n")
+    print_cache_stats()
+
+
+# Uses the DHT membership from the server, forgetting cached results if it changed
+def adopt_membership(tuples):
+    global known_addresses
+    if tuples != known_addresses:
+        result_cache.clear()
+    known_addresses = tuples
+
+
+# Forgets cached query results, called whenever the DHT membership changes
+def invalidate_caches():
+    result_cache.clear()
+
+
+# Hit and miss counters of the query result cache
+def cache_stats():
+    return dict(results=result_cache.stats())
+
+
+# Prints the counters of the caches
+def print_cache_stats():
+    stats = cache_stats()
+    print("Cache: " + ", ".join(name + " " + str(counts["hits"]) + " hits / " + str(counts["misses"]) + " misses"
+                                for name, counts in stats.items()) + "\n")
+
+
+# Datagram counters of this node: sent, received, dropped by the kernel because a receive
+# buffer was full (None if the OS does not report it), and those of the acked ring channel
+def transport_stats():
+    counts = dict(DHTTransport.stats)
+    left_drops = DHTTransport.receive_drops(port_left)
+    query_drops = DHTTransport.receive_drops(port_query)
+    counts["receive_drops"] = None if left_drops is None else left_drops + (query_drops or 0)
+    return counts
+
+
+# Prints the datagram counters of this node
+def print_transport_stats():
+    counts = transport_stats()
+    print("Datagrams: " + str(counts.get("datagrams_sent", 0)) + " sent, " + str(counts.get("datagrams_received", 0)) +
+          " received, " + str(counts["receive_drops"]) + " dropped by the kernel, " +
+          str(counts.get("retransmits", 0)) + " resent, " + str(counts.get("window_cuts", 0)) + " window cuts" +
+          ("" if not counts.get("stream_writes") else ", tcp: " + str(counts.get("stream_messages", 0)) +
+           " messages received, " + str(counts["stream_writes"]) + " writes") + "\n")
+
+
+# Sends a query for long_name without waiting. Returns a Future that resolves to the
+# query_success/query_failed reply, or fails with TimeoutError after timeout seconds
+def lookup(long_name, entry_addr=None, timeout=None):
+    global port_query, local_ip, known_addresses
+
+    # Answer from the cache without leaving the process
+    record = result_cache.get(long_name)
+    if record is not DHTCache.missing:
+        future = Future()
+        future.set_result(cached_reply(long_name, record))
+        return future
+
+    members = known_addresses or dht_addresses
+    size = len(members) if members else ring_size
+
+    hash_output = hash_key(long_name, members)
 
     # Define Information that will be forwarded in the cycle
     forward_information = dict()
@@ -342,29 +1180,286 @@ def submit_query(params, cmd_params):
     forward_information["long_name"] = long_name
     forward_information["pos"] = hash_output["pos"]
     forward_information["node_id"] = hash_output["node_id"]
+    forward_information["key_hash"] = hash_output["key_hash"]
+    forward_information["ring_size"] = size
+    forward_information["hash_name"] = hash_name
+    forward_information["placement"] = placement
     forward_information["return_addr"] = (local_ip, port_query)
-
-    # Get query addr
-    query_addr = (params["tuple"][1], params["tuple"][3])
-
-    # Send query
-    send(forward_information, query_addr)
-    sleep(3)
+    forward_information["request_id"] = next(request_ids)
+
+    # Send straight to the query port of the least busy replica. If the membership is
+    # stale, the node that receives it forwards the query along the ring instead
+    node = None
+    if routing_mode == 'direct' and 0 <= hash_output["node_id"] < len(known_addresses):
+        owner = least_loaded(replica_nodes(hash_output["node_id"], known_addresses))
+        query_addr = (owner[1], owner[3])
+        node = owner[0]
+    elif entry_addr is not None:
+        query_addr = entry_addr
+    else:
+        entry = random.choice(known_addresses)
+        query_addr = (entry[1], entry[3])
+
+    future = send_lookup(forward_information, query_addr, timeout, node)
+    if node is not None:
+        future = ring_fallback(future, forward_information, entry_addr, timeout)
+    generation = result_cache.generation
+    future.add_done_callback(lambda done: cache_reply(long_name, done, generation))
+    return future
+
+
+# Returns a Future for the reply to a query sent straight to its owner. If the owner replies
+# that it is not in the DHT (the cached membership is outdated), the query is sent once more
+# through the ring at entry_addr, or at a random member
+def ring_fallback(future, query, entry_addr, timeout):
+    result = Future()
+    future.add_done_callback(lambda done: resend_stale(done, result, query, entry_addr, timeout))
+    return result
+
+
+# Sends a query again through the ring if its reply done was stale, then resolves result
+def resend_stale(done, result, query, entry_addr, timeout):
+    if done.exception() is not None or not done.result().get("stale"):
+        copy_future(done, result)
+        return
+    if entry_addr is None:
+        entry = random.choice(known_addresses)
+        entry_addr = (entry[1], entry[3])
+    resent = send_lookup(dict(query, request_id=next(request_ids), hops=0), entry_addr, timeout)
+    resent.add_done_callback(lambda last: copy_future(last, result))
+
+
+# Resolves target like the finished future source
+def copy_future(source, target):
+    if source.exception() is not None:
+        target.set_exception(source.exception())
+    else:
+        target.set_result(source.result())
+
+
+# Caches the record of a query reply, unless the DHT membership changed while it was on its way.
+# A record that was not found is not cached, it may be on its way to its node in a migration
+def cache_reply(long_name, future, generation):
+    if future.exception() is None and future.result().get("code") == "query_success":
+        result_cache.put(long_name, future.result().get("record"), generation)
+
+
+# A query reply for a record found in the cache
+def cached_reply(long_name, record):
+    return dict(code="query_success", long_name=long_name, record=record, hops=0, cached=True,
+                message="Data Record for " + long_name + ":\n" + str(record) + "\n(Cached)")
+
+
+# Picks the node with the fewest lookups in flight from this client, at random among the least busy
+def least_loaded(nodes):
+    with pending_lock:
+        load = [node_load[node[0]] for node in nodes]
+    return random.choice([node for node, count in zip(nodes, load) if count == min(load)])
+
+
+# Sends a query and registers the Future that its reply will resolve. node is the name
+# of the node the query is sent to, its load counts the query until the future is done
+def send_lookup(query, query_addr, timeout=None, node=None, ring=False):
+    future = Future()
+    with pending_lock:
+        pending_lookups[query["request_id"]] = (future, monotonic() + (timeout or lookup_timeout))
+        if node is not None:
+            node_load[node] += 1
+            future.add_done_callback(lambda done: release_node(node))
+    send(query, query_addr, ring=ring)
+    return future
+
+
+# Counts a lookup sent to node as done
+def release_node(node):
+    with pending_lock:
+        node_load[node] -= 1
+        if node_load[node] <= 0:
+            del node_load[node]
+
+
+# Scans every node of the DHT for the rows whose key starts with prefix and is in [start, end)
+# and whose value in column is value, leaving out the conditions that are None. Returns a
+# Future that resolves to the rows in key order, or fails with TimeoutError if no rows arrive
+# for timeout seconds
+def scan(prefix=None, start=None, end=None, column=None, value=None, entry_addr=None, timeout=None):
+    request = dict(code="scan", prefix=prefix, start=start, end=end, column=column, value=value,
+                   return_addr=(local_ip, port_query), request_id=next(request_ids), hops=0)
+    if entry_addr is None:
+        entry = random.choice(known_addresses or dht_addresses)
+        entry_addr = (entry[1], entry[3])
+    with pending_lock:
+        pending_scans[request["request_id"]] = dict(rows=[], nodes=dict(), ring_size=None, key_column=None,
+                                                    timeout=timeout or lookup_timeout)
+    future = send_lookup(request, entry_addr, timeout)
+    future.add_done_callback(lambda done: forget_scan(request["request_id"]))
+    return future
+
+
+# Drops the rows of a scan that finished or timed out
+def forget_scan(request_id):
+    with pending_lock:
+        pending_scans.pop(request_id, None)
+
+
+# Sends queries for many long names at once, grouped by the node that owns them.
+# Returns a dict of long name -> record (None if not in the DHT), leaving out
+# the names whose node did not reply within timeout seconds
+def mget(long_names, entry_addr=None, timeout=None):
+    global known_addresses, hash_name, placement, vnodes
+    members = known_addresses or dht_addresses
+    direct = routing_mode == 'direct' and len(known_addresses) > 0
+
+    records = dict()
+    keys = []
+    for long_name in dict.fromkeys(long_names):
+        record = result_cache.get(long_name)
+        if record is DHTCache.missing:
+            keys.append(long_name)
+        else:
+            records[long_name] = record
+    generation = result_cache.generation
+
+    for attempt in range(2):
+        if not keys:
+            break
+        futures = []
+        for node_id, node_keys in group_keys(keys, members).items():
+            for i in range(0, len(node_keys), mget_keys):
+                query = dict(code="mquery", keys=node_keys[i:i + mget_keys], node_id=node_id, ring_size=len(members),
+                             hash_name=hash_name, placement=placement, return_addr=(local_ip, port_query),
+                             request_id=next(request_ids))
+                node = None
+                if direct and node_id < len(known_addresses):
+                    replica = least_loaded(replica_nodes(node_id, known_addresses))
+                    query_addr = (replica[1], replica[3])
+                    node = replica[0]
+                elif entry_addr is not None:
+                    query_addr = entry_addr
+                else:
+                    entry = random.choice(known_addresses)
+                    query_addr = (entry[1], entry[3])
+                futures.append(send_lookup(query, query_addr, timeout, node))
+
+        # Gather the partial results, retrying keys that were hashed differently than the DHT
+        keys = []
+        for future in futures:
+            try:
+                reply = future.result()
+            except TimeoutError:
+                continue
+            if reply.get("stale"):
+                keys.extend(long_name for long_name, pos in reply["keys"])
+                direct = False  # Send them through the ring
+                if not reply.get("tuples"):
+                    continue    # The node has left the DHT, the cached membership is outdated
+                result_cache.clear()    # Results were cached for another membership
+                generation = result_cache.generation
+                members = reply["tuples"]
+                hash_name = reply["hash_name"]     # Hash the keys like the DHT does from now on
+                placement = reply["placement"]
+                vnodes = reply["vnodes"]
+            else:
+                records.update(reply["records"])
+                for long_name, record in reply["records"].items():
+                    if record is not None:
+                        result_cache.put(long_name, record, generation)
+    return records
+
+
+# Groups (long name, pos) pairs by the node that owns them
+def group_keys(long_names, members):
+    groups = dict()
+    for long_name in long_names:
+        hash_output = hash_key(long_name, members)
+        groups.setdefault(hash_output["node_id"], []).append((long_name, hash_output["pos"]))
+    return groups
+
+
+# Sends a multi-key query to the DHT and prints every record
+def submit_mquery(params, cmd_params):
+    print("Enter long names to query, one per line (blank line to finish):")
+    long_names = []
+    long_name = input()
+    while long_name:
+        long_names.append(long_name)
+        long_name = input()
+
+    # Cache the DHT membership sent by the server
+    if "tuples" in params:
+        adopt_membership(params["tuples"])
+
+    start = perf_counter()
+    records = mget(long_names, (params["tuple"][1], params["tuple"][3]))
+    elapsed = perf_counter() - start
+    for long_name in long_names:
+        if long_name not in records:
+            print("No reply for '" + long_name + "'")
+        elif records[long_name] is None:
+            print("Record associated with '" + long_name + "' is not found in DHT")
+        else:
+            print("Data Record for " + long_name + ":\n" + str(records[long_name]))
+    print("\nQueried " + str(len(long_names)) + " keys in " + "%.3f" % elapsed + "s")
+    print_cache_stats()
+
+
+# Scans the DHT for the rows in a key range or with a key prefix, and a column value, and
+# prints every row in key order
+def submit_scan(params, cmd_params):
+    print("Enter a key prefix, or a key range as start..end (blank for every key):")
+    keys = input()
+    print("Enter column=value to match (blank for every row):")
+    match = input()
+    prefix = start = end = column = value = None
+    if ".." in keys:
+        start, end = [bound or None for bound in keys.split("..", 1)]
+    elif keys:
+        prefix = keys
+    if "=" in match:
+        column, value = match.split("=", 1)
+
+    # Cache the DHT membership sent by the server
+    if "tuples" in params:
+        adopt_membership(params["tuples"])
+
+    start_time = perf_counter()
+    future = scan(prefix, start, end, column, value, (params["tuple"][1], params["tuple"][3]))
+    try:
+        rows = future.result()
+    except TimeoutError:
+        print("Scan did not finish, no rows arrived for " + str(lookup_timeout) + " seconds\n")
+        return
+    elapsed = perf_counter() - start_time
+    for row in rows:
+        print(str(row))
+    print("\nScanned " + str(len(rows)) + " rows in " + "%.3f" % elapsed + "s")
 
 
 # Starts the teardown process. This will always be started by the leader.
 def initiate_teardown(params, cmd_params):
     global next_addr
     params["code"] = "teardown"
-    send(params, next_addr)
+    send(params, next_addr, ring=True)
 
 
+# Hands every record to its node in the DHT without this client, sending the ones that were
+# not acked again, then leaves. Records still not acked after migrate_tries rounds are kept
+# here instead of cleared, and go to their nodes when this client joins the DHT again
 def initiate_leave(params, cmd_params):
     global next_addr, my_name
     params["code"] = "leave"
     params["original"] = my_name
-    send(params, next_addr)
-    reset_dht_globals()
+    kept = migrate_records(params["tuples"])
+    for attempt in range(1, migrate_tries):
+        if not kept:
+            break
+        print("Sending the " + str(kept) + " records that were not acked again...")
+        kept = migrate_records(params["tuples"])
+    send(params, next_addr, ring=True)
+    reset_dht_globals(keep_rows=kept > 0)
+    if kept:
+        print("\n" + str(kept) + " records were not acked by their nodes and stay on this client until it joins "
+              "the DHT again.")
     print("\nThis client has successfully been removed from the DHT.")
 
 
@@ -381,9 +1476,11 @@ def join_dht(params, cmd_params):
     identifier = len(dht_addresses)
     # dht_addresses.append((my_name, local_ip, port_left, port_query))
 
+    previous = [address for address in dht_addresses if address[0] != my_name]
+
     params["tuples"] = dht_addresses
     params["dht_size"] = len(dht_addresses)
-    config_dht_users(params, [])
+    config_dht_users(params, [], previous)
     print("\nThis client has successfully been added to the DHT.")
 
     send("dht-rebuilt " + str(my_name) + " " + str(dht_addresses[0][0]), params["serverAddr"], True)
@@ -394,6 +1491,8 @@ special_instructions = dict(
     setup_dht=config_dht_users,
     register=start_listening,
     query_dht=submit_query,
+    mquery_dht=submit_mquery,
+    scan_dht=submit_scan,
     teardown_dht=initiate_teardown,
     leave_dht=initiate_leave,
     join_dht=join_dht
@@ -409,9 +1508,22 @@ if __name__ == '__main__':
     ip_prompt = 'Input Server IPv4: '
     port_prompt = 'Input Server port (' + str(port_min) + '-' + str(port_max) + '): '
 
-    if len(sys.argv) == 3:
+    if len(sys.argv) >= 3:
         HOST = sys.argv[1]
         PORT = int(sys.argv[2])
+        if len(sys.argv) >= 4:
+            csv_path = sys.argv[3]     # Loaded if this client leads a DHT
+        if len(sys.argv) >= 5:
+            key_column = sys.argv[4]
+        if len(sys.argv) >= 6:
+            ingest_workers = int(sys.argv[5])
+        if len(sys.argv) >= 7:
+            storage = sys.argv[6]
+        if len(sys.argv) >= 8:
+            transport = sys.argv[7]
+        if len(sys.argv) >= 9:
+            indexed_columns = tuple(column for column in sys.argv[8].split(",") if column)
+        hash_table = DHTStorage.new_store(storage, key_column, indexed_columns)
     else:
         HOST = str(input(ip_prompt))
         PORT = int(input(port_prompt))
@@ -421,25 +1533,30 @@ if __name__ == '__main__':
         print("Port " + str(PORT) + " is invalid")
         PORT = int(input(port_prompt))
 
+    client_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)     # Reused for every server command
+    atexit.register(client_sock.close)
+    atexit.register(DHTTransport.close_sender)
+
     while True:
         sleep(1)
 
         # Get command
         command = str(input())
-        client_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        command_attrs = command.split(" ")
+        basic_command = command_attrs[0].replace("-", "_")
+        command_params = command_attrs[1:]
+
+        # Every command goes to the server, which decides if it is allowed now
         client_sock.sendto(command.encode('utf-8'), (HOST, PORT))
 
         # Get response
         serverMsg, serverAddr = client_sock.recvfrom(65535)
 
-        info = pickle.loads(serverMsg)
+        info = DHTCodec.decode(serverMsg, accept_pickle or wire_format == 'pickle')
         print("Status: " + info["code"]) # + "\n" + info["msg"] + "\n")
         # print("Additional Info: " + str(info["added"]))
 
         # Determine if further instructions are needed
-        command_attrs = command.split(" ")
-        basic_command = command_attrs[0].replace("-", "_")
-        command_params = command_attrs[1:]
         if basic_command in special_instructions and info["code"] == "SUCCESS":
             info["added"]["serverAddr"] = serverAddr
             special_instructions[basic_command](info["added"], command_params)
@@ -0,0 +1,335 @@
+# Zachary Garrett
+
+import struct
+import pickle
+
+magic = 0xD7    # First byte of every binary message (a pickle starts with 0x80)
+version = 12    # Bumped whenever a schema, a value encoding or the placement of keys changes
+
+# Fields of every message code, packed in this order without their names.
+# Codes are numbered by position, so new codes must be added at the end
+schemas = dict(
+    setup=("next", "ring_size", "identifier", "all_addresses", "wire_format", "hash_name", "leader", "placement",
+           "vnodes", "replicas", "key_column", "snapshot", "request_id", "return_addr", "transport"),
+    store_row=("data_row",),
+    query=("long_name", "pos", "node_id", "ring_size", "return_addr", "request_id", "hops", "key_hash", "hash_name",
+           "placement", "reply_format"),
+    mquery=("keys", "node_id", "ring_size", "return_addr", "request_id", "hops", "hash_name", "placement",
+            "reply_format"),
+    query_success=("long_name", "record", "message", "hops", "request_id", "replica"),
+    query_failed=("long_name", "record", "message", "hops", "request_id", "replica"),
+    mquery_success=("records", "message", "hops", "request_id", "stale", "ring_size", "keys", "hash_name", "tuples",
+                    "placement", "vnodes"),
+    teardown=("serverAddr", "message", "tuples"),
+    leave=("tuples", "original", "serverAddr", "message", "dht_size"),
+    SUCCESS=("msg", "added"),
+    FAILURE=("msg", "added"),
+    migrate=("header", "rows", "request_id", "return_addr", "key_column"),
+    migrate_ack=("stored", "message", "request_id"),
+    setup_ack=("request_id", "records", "restored", "message"),
+    scan=("prefix", "start", "end", "column", "value", "return_addr", "request_id", "hops", "reply_format"),
+    scan_rows=("request_id", "header", "rows", "node", "last", "matched", "ring_size", "key_column")
+)
+codes = list(schemas)
+code_ids = dict((code, i) for i, code in enumerate(codes))
+no_schema = 0xFF    # Code id of messages whose code has no schema, their code travels as a field
+
+header = struct.Struct('!BBB')  # magic, version, code id
+int8 = struct.Struct('!b')
+int32 = struct.Struct('!i')
+int64 = struct.Struct('!q')
+uint8 = struct.Struct('!B')
+uint32 = struct.Struct('!I')
+uint64 = struct.Struct('!Q')
+double = struct.Struct('!d')
+
+
+# Raised when a datagram cannot be decoded
+class CodecError(ValueError):
+    pass
+
+
+# Encodes a message dict in the given format ('binary' or 'pickle')
+def encode(msg, wire_format='binary'):
+    if wire_format == 'pickle':
+        return pickle.dumps(msg)
+
+    code = msg.get("code")
+    schema = schemas.get(code, ())
+    out = [header.pack(magic, version, code_ids.get(code, no_schema))]
+    for field in schema:
+        if field in msg:
+            pack(msg[field], out)
+        else:
+            out.append(b'-')    # Field not present
+
+    # Fields without a place in the schema are packed with their names
+    extras = dict((key, value) for key, value in msg.items() if key not in schema and key != "code")
+    if code not in code_ids:
+        extras["code"] = code
+    pack(extras, out)
+    return b''.join(out)
+
+
+# Decodes a message encoded by encode, pickles are only accepted if allow_pickle is set
+def decode(data, allow_pickle=False):
+    if not data:
+        raise CodecError("Empty message")
+    if data[0] != magic:
+        if data[0] == 0x80 and allow_pickle:
+            return pickle.loads(data)
+        raise CodecError("Not a binary DHT message")
+    if len(data) < header.size:
+        raise CodecError("Truncated header")
+
+    first, msg_version, code_id = header.unpack_from(data, 0)
+    if msg_version != version:
+        raise CodecError("Unsupported message version " + str(msg_version))
+
+    try:
+        msg = dict()
+        offset = header.size
+        if code_id != no_schema:
+            code = codes[code_id]
+            msg["code"] = code
+            for field in schemas[code]:
+                if data[offset] == 0x2D:    # '-', field not present
+                    offset += 1
+                else:
+                    msg[field], offset = unpack(data, offset)
+        extras, offset = unpack(data, offset)
+    except (IndexError, KeyError, struct.error, ValueError, TypeError, RecursionError) as e:
+        raise CodecError("Malformed message: " + repr(e))
+    if offset != len(data) or not isinstance(extras, dict):
+        raise CodecError("Malformed message: unexpected data after the fields")
+    msg.update(extras)
+    return msg
+
+
+# Encodes a single value (used for rows that travel inside a batch)
+def pack_value(value):
+    out = []
+    pack(value, out)
+    return b''.join(out)
+
+
+# Decodes a value encoded by pack_value
+def unpack_value(data):
+    return unpack(data, 0)[0]
+
+
+# Appends the tagged encoding of value to out
+def pack(value, out):
+    try:
+        packer = packers[type(value)]
+    except KeyError:
+        raise CodecError("Cannot encode " + type(value).__name__)
+    packer(value, out)
+
+
+def pack_none(value, out):
+    out.append(b'N')
+
+
+def pack_bool(value, out):
+    out.append(b'1' if value else b'0')
+
+
+def pack_int(value, out):
+    if -128 <= value < 128:
+        out.append(b'b' + int8.pack(value))
+    elif -2147483648 <= value < 2147483648:
+        out.append(b'i' + int32.pack(value))
+    elif -9223372036854775808 <= value < 9223372036854775808:
+        out.append(b'q' + int64.pack(value))
+    elif 0 <= value <= 0xFFFFFFFFFFFFFFFF:
+        out.append(b'Q' + uint64.pack(value))     # 64-bit key hashes
+    else:
+        digits = str(value).encode('ascii')
+        out.append(b'I' + uint32.pack(len(digits)) + digits)
+
+
+def pack_float(value, out):
+    out.append(b'f' + double.pack(value))
+
+
+def pack_str(value, out):
+    data = value.encode('utf-8', 'surrogatepass')
+    if len(data) < 256:
+        out.append(short_str[len(data)] + data)
+    else:
+        out.append(b'S' + uint32.pack(len(data)) + data)
+
+
+def pack_bytes(value, out):
+    out.append(b'y' + uint32.pack(len(value)))
+    out.append(bytes(value))
+
+
+# Containers of fewer than 256 items use a lowercase tag and a one byte count
+def pack_list(value, out):
+    out.append(b'l' + uint8.pack(len(value)) if len(value) < 256 else b'L' + uint32.pack(len(value)))
+    for item in value:
+        pack(item, out)
+
+
+def pack_tuple(value, out):
+    out.append(b't' + uint8.pack(len(value)) if len(value) < 256 else b'T' + uint32.pack(len(value)))
+    for item in value:
+        pack(item, out)
+
+
+def pack_dict(value, out):
+    out.append(b'd' + uint8.pack(len(value)) if len(value) < 256 else b'D' + uint32.pack(len(value)))
+    for key, item in value.items():
+        pack(key, out)
+        pack(item, out)
+
+
+short_str = [b's' + uint8.pack(length) for length in range(256)]   # Tag and length of each short string size
+
+packers = {
+    type(None): pack_none,
+    bool: pack_bool,
+    int: pack_int,
+    float: pack_float,
+    str: pack_str,
+    bytes: pack_bytes,
+    bytearray: pack_bytes,
+    list: pack_list,
+    tuple: pack_tuple,
+    dict: pack_dict
+}
+
+
+# Decodes the value starting at offset, returns it and the offset after it
+def unpack(data, offset):
+    return unpackers[data[offset]](data, offset + 1)
+
+
+def unpack_none(data, offset):
+    return None, offset
+
+
+def unpack_true(data, offset):
+    return True, offset
+
+
+def unpack_false(data, offset):
+    return False, offset
+
+
+def unpack_int8(data, offset):
+    return int8.unpack_from(data, offset)[0], offset + 1
+
+
+def unpack_int32(data, offset):
+    return int32.unpack_from(data, offset)[0], offset + 4
+
+
+def unpack_int64(data, offset):
+    return int64.unpack_from(data, offset)[0], offset + 8
+
+
+def unpack_uint64(data, offset):
+    return uint64.unpack_from(data, offset)[0], offset + 8
+
+
+def unpack_bigint(data, offset):
+    length = uint32.unpack_from(data, offset)[0]
+    offset += 4
+    if offset + length > len(data):
+        raise IndexError("integer runs past the end of the message")
+    return int(data[offset:offset + length]), offset + length
+
+
+def unpack_float(data, offset):
+    return double.unpack_from(data, offset)[0], offset + 8
+
+
+def unpack_short_str(data, offset):
+    length = data[offset]
+    offset += 1
+    if offset + length > len(data):
+        raise IndexError("string runs past the end of the message")
+    return str(data[offset:offset + length], 'utf-8', 'surrogatepass'), offset + length
+
+
+def unpack_str(data, offset):
+    length = uint32.unpack_from(data, offset)[0]
+    offset += 4
+    if offset + length > len(data):
+        raise IndexError("string runs past the end of the message")
+    return str(data[offset:offset + length], 'utf-8', 'surrogatepass'), offset + length
+
+
+def unpack_bytes(data, offset):
+    length = uint32.unpack_from(data, offset)[0]
+    offset += 4
+    if offset + length > len(data):
+        raise IndexError("bytes run past the end of the message")
+    return bytes(data[offset:offset + length]), offset + length
+
+
+def unpack_items(data, offset, count):
+    items = []
+    for i in range(count):
+        item, offset = unpackers[data[offset]](data, offset + 1)
+        items.append(item)
+    return items, offset
+
+
+def unpack_short_list(data, offset):
+    return unpack_items(data, offset + 1, data[offset])
+
+
+def unpack_list(data, offset):
+    return unpack_items(data, offset + 4, uint32.unpack_from(data, offset)[0])
+
+
+def unpack_short_tuple(data, offset):
+    items, offset = unpack_items(data, offset + 1, data[offset])
+    return tuple(items), offset
+
+
+def unpack_tuple(data, offset):
+    items, offset = unpack_items(data, offset + 4, uint32.unpack_from(data, offset)[0])
+    return tuple(items), offset
+
+
+def unpack_pairs(data, offset, count):
+    items = dict()
+    for i in range(count):
+        key, offset = unpackers[data[offset]](data, offset + 1)
+        items[key], offset = unpackers[data[offset]](data, offset + 1)
+    return items, offset
+
+
+def unpack_short_dict(data, offset):
+    return unpack_pairs(data, offset + 1, data[offset])
+
+
+def unpack_dict(data, offset):
+    return unpack_pairs(data, offset + 4, uint32.unpack_from(data, offset)[0])
+
+
+unpackers = dict((ord(tag), unpacker) for tag, unpacker in (
+    ('N', unpack_none),
+    ('1', unpack_true),
+    ('0', unpack_false),
+    ('b', unpack_int8),
+    ('i', unpack_int32),
+    ('q', unpack_int64),
+    ('Q', unpack_uint64),
+    ('I', unpack_bigint),
+    ('f', unpack_float),
+    ('s', unpack_short_str),
+    ('S', unpack_str),
+    ('y', unpack_bytes),
+    ('l', unpack_short_list),
+    ('L', unpack_list),
+    ('t', unpack_short_tuple),
+    ('T', unpack_tuple),
+    ('d', unpack_short_dict),
+    ('D', unpack_dict)
+))
@@ -0,0 +1,66 @@
+# Zachary Garrett
+
+import hashlib
+import bisect
+
+# xxhash is optional, it is only offered when installed
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
+
+table_size = 353    # Number of hash table positions shown for a key, placement uses the whole hash
+
+fnv_offset = 0xcbf29ce484222325     # 64-bit FNV-1a parameters
+fnv_prime = 0x100000001b3
+mask64 = 0xFFFFFFFFFFFFFFFF
+
+
+# Sum of the character codes of the key (the original hash, anagrams collide)
+def sum_hash(key):
+    return sum(map(ord, key))
+
+
+# 64-bit FNV-1a of the key's utf-8 bytes
+def fnv1a_hash(key):
+    value = fnv_offset
+    for byte in key.encode('utf-8'):
+        value = ((value ^ byte) * fnv_prime) & mask64
+    return value
+
+
+# First 64 bits of the blake2b digest of the key
+def blake2b_hash(key):
+    return int.from_bytes(hashlib.blake2b(key.encode('utf-8'), digest_size=8).digest(), 'big')
+
+
+# 64-bit xxHash of the key
+def xxhash_hash(key):
+    return xxhash.xxh64_intdigest(key.encode('utf-8'))
+
+
+# Hash functions by name, every one maps a key string to a non-negative int
+hash_functions = dict(
+    sum=sum_hash,
+    fnv1a=fnv1a_hash,
+    blake2b=blake2b_hash
+)
+if xxhash is not None:
+    hash_functions["xxhash"] = xxhash_hash
+
+
+# Consistent hash ring. Every node gets vnodes points on a 64-bit circle and owns the
+# keys that hash up to its point, so adding or removing a node only moves the keys
+# next to that node's points. Keys need a 64-bit hash (not sum) to spread over the circle
+class HashRing:
+
+    def __init__(self, names, vnodes=64):
+        points = sorted((blake2b_hash(name + "#" + str(i)), node_id)
+                        for node_id, name in enumerate(names) for i in range(vnodes))
+        self.points = [point for point, node_id in points]
+        self.owners = [node_id for point, node_id in points]
+
+    # Returns the node_id (position in names) of the node that owns key_hash
+    def owner(self, key_hash):
+        i = bisect.bisect_left(self.points, key_hash & mask64)
+        return self.owners[i % len(self.points)]
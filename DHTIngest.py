@@ -0,0 +1,117 @@
+# Zachary Garrett
+
+import os
+import io
+import collections
+from csv import reader
+import DHTCodec
+import DHTHash
+
+# numpy is optional, it hashes the keys of a chunk in one pass when installed
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+chunk_bytes = 4 * 1024 * 1024   # Bytes of the csv one worker parses at a time
+vector_hashes = ("fnv1a",)  # Hash functions with a numpy version
+
+rings = dict()  # (member names, vnodes) -> DHTHash.HashRing, built once per worker process
+
+
+# Returns the csv header of the file at path and the (start, end) byte ranges of its rows,
+# each about size bytes and starting at the beginning of a line. Lines may end in \n or, like
+# StatsCountry.csv, in \r alone. Rows must not contain line breaks inside quoted fields, since
+# a range could then start in the middle of a row
+def split_file(path, size=None):
+    size = size or chunk_bytes
+    with open(path, 'rb') as read_obj:
+        first = read_obj.read(64 * 1024)
+        newline = b'\n' if b'\n' in first else b'\r'
+        start = line_end(read_obj, 0, newline)
+        read_obj.seek(0)
+        header = next(reader([read_obj.read(start).decode('utf-8', 'ignore').rstrip('\r\n')]))
+        end_of_file = os.fstat(read_obj.fileno()).st_size
+        ranges = []
+        while start < end_of_file:
+            end = line_end(read_obj, min(start + size, end_of_file), newline)
+            ranges.append((start, end))
+            start = end
+    return header, ranges
+
+
+# Returns the offset after the first newline at or after offset, or the end of the file
+def line_end(read_obj, offset, newline):
+    read_obj.seek(offset)
+    while True:
+        block = read_obj.read(64 * 1024)
+        if not block:
+            return offset
+        i = block.find(newline)
+        if i >= 0:
+            return offset + i + 1
+        offset += len(block)
+
+
+# Parses the rows of path between start and end and groups them by the node that owns them.
+# settings holds the key_column, hash_name, placement, vnodes and member names of the DHT.
+# Returns a dict of node_id -> (packed rows, keys). Runs in a worker process
+def partition_chunk(path, start, end, header, settings):
+    with open(path, 'rb') as read_obj:
+        read_obj.seek(start)
+        text = read_obj.read(end - start).decode('utf-8', 'ignore')
+    column = header.index(settings["key_column"])
+    rows = [row for row in reader(io.StringIO(text, newline='')) if row]
+    keys = [row[column] for row in rows]
+    node_ids = place_keys(keys, settings)
+
+    groups = collections.defaultdict(lambda: ([], []))
+    for row, key, node_id in zip(rows, keys, node_ids):
+        group = groups[node_id]
+        group[0].append(DHTCodec.pack_value(row))
+        group[1].append(key)
+    return dict(groups)
+
+
+# Returns the node_id of every key, the same as the client's place does one key at a time
+def place_keys(keys, settings):
+    names = settings["names"]
+    if numpy is not None and settings["hash_name"] in vector_hashes:
+        key_hashes = fnv1a_hashes(keys)
+        if settings["placement"] != 'consistent':
+            return (key_hashes % numpy.uint64(len(names))).tolist()
+        ring = hash_ring(names, settings["vnodes"])
+        points = numpy.array(ring.points, dtype=numpy.uint64)
+        i = numpy.searchsorted(points, key_hashes, side='left') % len(points)
+        return numpy.array(ring.owners)[i].tolist()
+
+    hash_function = DHTHash.hash_functions[settings["hash_name"]]
+    if settings["placement"] != 'consistent':
+        return [hash_function(key) % len(names) for key in keys]
+    ring = hash_ring(names, settings["vnodes"])
+    return [ring.owner(hash_function(key)) for key in keys]
+
+
+# Hash ring of the given members, kept for the next chunk this process parses
+def hash_ring(names, vnodes):
+    ring = rings.get((names, vnodes))
+    if ring is None:
+        ring = rings[(names, vnodes)] = DHTHash.HashRing(names, vnodes)
+    return ring
+
+
+# 64-bit FNV-1a of every key, one numpy pass per byte position instead of one Python loop
+# per byte. Equal to DHTHash.fnv1a_hash of each key
+def fnv1a_hashes(keys):
+    data = [key.encode('utf-8') for key in keys]
+    lengths = numpy.fromiter(map(len, data), dtype=numpy.int64, count=len(data))
+    offsets = numpy.zeros(len(data), dtype=numpy.int64)
+    numpy.cumsum(lengths[:-1], out=offsets[1:])
+    buffer = numpy.frombuffer(b''.join(data) + b'\0', dtype=numpy.uint8)
+    values = numpy.full(len(data), DHTHash.fnv_offset, dtype=numpy.uint64)
+    prime = numpy.uint64(DHTHash.fnv_prime)
+    for i in range(int(lengths.max(initial=0))):
+        live = lengths > i
+        byte = buffer[numpy.where(live, offsets + i, len(buffer) - 1)].astype(numpy.uint64)
+        values = numpy.where(live, (values ^ byte) * prime, values)   # uint64 products wrap like & mask64
+    return values
@@ -0,0 +1,72 @@
+# Zachary Garrett
+
+import threading
+from contextlib import contextmanager
+
+
+# Lock that lets any number of threads read at once, or one thread write. A waiting writer
+# goes before readers that arrive after it, so a steady stream of queries cannot hold off a
+# store forever. The writer may take the lock again, and read, while it holds it. A reader
+# must not take it again, since a writer waiting in between would wait for that reader
+class ReadWriteLock:
+
+    def __init__(self):
+        self.ready = threading.Condition()
+        self.readers = 0
+        self.writer = None  # Thread that holds the write lock
+        self.depth = 0  # Times the writer took the lock without releasing it
+        self.waiting = 0    # Writers waiting for the readers to leave
+
+    def acquire_read(self):
+        with self.ready:
+            if self.writer is threading.current_thread():
+                self.depth += 1
+                return
+            while self.writer is not None or self.waiting:
+                self.ready.wait()
+            self.readers += 1
+
+    def release_read(self):
+        with self.ready:
+            if self.writer is threading.current_thread():
+                self.depth -= 1
+                return
+            self.readers -= 1
+            if not self.readers:
+                self.ready.notify_all()
+
+    def acquire_write(self):
+        me = threading.current_thread()
+        with self.ready:
+            if self.writer is me:
+                self.depth += 1
+                return
+            self.waiting += 1
+            while self.writer is not None or self.readers:
+                self.ready.wait()
+            self.waiting -= 1
+            self.writer = me
+            self.depth = 1
+
+    def release_write(self):
+        with self.ready:
+            self.depth -= 1
+            if not self.depth:
+                self.writer = None
+                self.ready.notify_all()
+
+    @contextmanager
+    def reading(self):
+        self.acquire_read()
+        try:
+            yield
+        finally:
+            self.release_read()
+
+    @contextmanager
+    def writing(self):
+        self.acquire_write()
+        try:
+            yield
+        finally:
+            self.release_write()
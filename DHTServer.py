@@ -2,21 +2,63 @@
 
 import socket
 import random
-import pickle
 import sys
+import threading
+import DHTCodec
 
 echo_max = 255  # Max echo size
 port_min = 26500  # Minimum allowed port
 port_max = 26999  # Maximum allowed port
+wire_format = 'binary'  # Encoding of replies: 'binary' (DHTCodec) or 'pickle' for clients without DHTCodec
+server_workers = 4  # Threads that receive and handle requests, 0 handles them on the main thread only
+state_lock = threading.Lock()   # Held while a command reads or changes the server state
 
 # Global Variables
 state_info = dict()
 dht_exists = False
 accepting_requests = True
-free_clients = 0
 leader = ''
 stoppage_requester = ''
 dht_info = []
+dht_positions = dict()  # username -> position of the client in dht_info
+
+
+# Set of usernames that can also pick random members in O(1). Items live in a list
+# and a dict holds the position of each, removal moves the last item into the gap
+class IndexedSet:
+
+    def __init__(self):
+        self.items = []
+        self.positions = dict()
+
+    def __len__(self):
+        return len(self.items)
+
+    def __contains__(self, item):
+        return item in self.positions
+
+    def __iter__(self):
+        return iter(self.items)
+
+    def add(self, item):
+        if item not in self.positions:
+            self.positions[item] = len(self.items)
+            self.items.append(item)
+
+    def discard(self, item):
+        position = self.positions.pop(item, None)
+        if position is not None:
+            last = self.items.pop()
+            if position < len(self.items):
+                self.items[position] = last
+                self.positions[last] = position
+
+    # n distinct random items, random.sample only touches n of them when n is small
+    def sample(self, n):
+        return random.sample(self.items, n)
+
+
+clients_in = dict(free=IndexedSet(), indht=IndexedSet(), leader=IndexedSet())   # state -> usernames in that state
 
 
 # Maintains the metadata and return code of a client request
@@ -74,7 +116,6 @@ def handle_command(client_input):
 # Register the new client
 def register(params):
     info = RInfo()
-    global free_clients
     if len(params) != 4:
         info.set_msg("Invalid number of parameters (expected 4)")
         return info.failure()
@@ -92,7 +133,7 @@ def register(params):
     # Check for duplicates
     if uname not in state_info:
         state_info[uname] = client_info
-        free_clients += 1
+        clients_in["free"].add(uname)
         info.add_attr("client_info", client_info)
         return info.success()
     else:
@@ -103,7 +144,6 @@ def register(params):
 # Deregister a client
 def deregister(params):
     info = RInfo()
-    global free_clients
     if len(params) != 1:
         info.set_msg("Invalid number of parameters (expected 1)")
         return info.failure()
@@ -112,7 +152,7 @@ def deregister(params):
     uname = params[0]
     if uname in state_info and state_info[uname]["state"] == "free":
         state_info.pop(uname)
-        free_clients += -1
+        clients_in["free"].discard(uname)
         return info.success()
     else:
         info.set_msg(f"Either {uname} does not exist or is not 'free'.")
@@ -127,7 +167,6 @@ def setup_dht(params):
         info.set_msg("Invalid number of parameters (expected 2) OR the DHT already exists!")
         return info.failure()
 
-    global free_clients
     global leader
     global accepting_requests
     global dht_info
@@ -138,18 +177,20 @@ def setup_dht(params):
     uname_exists = uname in state_info
     valid_dht_size = dht_size >= 2
     valid_num_users = len(state_info) >= 2
-    valid_available_free = free_clients >= (dht_size - 1)
+    valid_available_free = len(clients_in["free"]) - (uname in clients_in["free"]) >= (dht_size - 1)
 
     # If requirements are met
     if uname_exists and valid_dht_size and valid_num_users and not dht_exists and valid_available_free:
-        state_info[uname]["state"] = "leader"               # Assign leader
+        assign_state([uname], "leader")                     # Assign leader
         leader = uname
 
         # Prepare information to pass to leader
-        random_clients = rand_choose(dht_size - 1, "free")  # Get n-1 random clients
+        # Get n-1 random clients, in name order so the same members always form the same ring
+        # and a node's snapshot from an earlier DHT of them matches
+        random_clients = sorted(rand_choose(dht_size - 1, "free"))
         assign_state(random_clients, "indht")               # Set random clients to InDHT
         tuples = get_tuples([uname] + random_clients)       # Retrieve tuples
-        dht_info = tuples
+        set_dht_info(tuples)
         dht_exists = True
         accepting_requests = False
 
@@ -169,21 +210,23 @@ def setup_dht(params):
 
 # Randomly choose n clients that are in state s
 def rand_choose(n, s):
-    keys = list(state_info.keys())
-    available_keys = list(range(0, len(keys)))
-    chosen = []
-    while len(chosen) < n:
-        index = random.choice(available_keys)
-        if state_info[keys[index]]["state"] == s:
-            chosen.append(keys[index])
-            available_keys.remove(index)
-    return chosen
+    return clients_in[s].sample(n)
 
 
 # Assigns the given state to the usernames provided
 def assign_state(usernames, state):
     for uname in usernames:
-        state_info[uname]["state"] = state
+        client = state_info[uname]
+        clients_in[client["state"]].discard(uname)
+        clients_in[state].add(uname)
+        client["state"] = state
+
+
+# Replaces the DHT membership and the position of each member in it
+def set_dht_info(tuples):
+    global dht_info, dht_positions
+    dht_info = tuples
+    dht_positions = dict((tup[0], i) for i, tup in enumerate(tuples))
 
 
 # Retrieves 4-tuples (username, ipv4, portl, portq)
@@ -232,6 +275,7 @@ def query_dht(params):
         rand_client = rand_choose(1, "indht")[0]            # Get random client in DHT
         client_tuple = get_tuples([rand_client])[0]         # Get tuple
         info.add_attr("tuple", client_tuple)                # Add tuple to return info
+        info.add_attr("tuples", dht_info)                   # Lets the client query the owner directly
         return info.success()
     else:
         info.set_msg("A query cannot be made at this time.")
@@ -251,22 +295,13 @@ def leave_dht(params):
 
     # Verify conditions
     uname_exists = uname in state_info
-    valid_state = state_info[uname]["state"] != "free"
+    valid_state = uname_exists and state_info[uname]["state"] != "free"
     global dht_exists, stoppage_requester, accepting_requests, dht_info
 
-    index = -1
-    for i in range(len(dht_info)):
-        if dht_info[i][0] == uname:
-            index = i
-            break
-
     # Update info
-    if index == len(dht_info) - 1:
-        dht_info = dht_info[:index]
-    elif index == 0:
-        dht_info = dht_info[1:]
-    else:
-        dht_info = dht_info[0:index] + dht_info[index + 1:]
+    index = dht_positions.get(uname)
+    if index is not None:
+        set_dht_info(dht_info[:index] + dht_info[index + 1:])
 
     # Add information to pass to the leader
     return_message = '\nDHT CLIENTS:'
@@ -279,7 +314,7 @@ def leave_dht(params):
         stoppage_requester = uname
         # accepting_requests = False                      # Deny any incoming requests
         info.set_msg(f"Waiting on clients to verify {uname} has been removed from the DHT...")
-        state_info[uname]["state"] = "free"
+        assign_state([uname], "free")
         return info.success()
     else:                                               # <username> cannot be removed
         info.set_msg(f"{uname} cannot be removed at this time.")
@@ -310,9 +345,9 @@ def join_dht(params):
         stoppage_requester = uname
         # accepting_requests = False                      # Deny any incoming requests
         info.set_msg(f"Waiting on clients to verify {uname} has been inserted into the DHT...")
-        dht_info.append(get_tuples([uname])[0])
+        set_dht_info(dht_info + get_tuples([uname]))
         info.add_attr("tuples", dht_info)
-        state_info[uname]["state"] = "indht"
+        assign_state([uname], "indht")
         # Add information to pass to the leader
         return_message = '\nDHT CLIENTS:'
         for tup in dht_info:
@@ -359,7 +394,7 @@ def teardown_complete(params):
     if leader == uname:
         accepting_requests = True
         dht_exists = False
-        assign_state(state_info.keys(), "free")
+        assign_state(list(clients_in["indht"]) + list(clients_in["leader"]), "free")  # Only the DHT's clients
         info.set_msg("DHT Teardown is successful.")
         return info.success()
     else:
@@ -396,13 +431,48 @@ def dht_rebuilt(params):
     else:
         # state_info[uname]["state"] = "free"
         if leader != new_leader:
-            state_info[leader]["state"] = "indht"
-            state_info[new_leader]["state"] = "leader"
+            if leader in dht_positions:     # The old leader has not left the DHT
+                assign_state([leader], "indht")
+            assign_state([new_leader], "leader")
             leader = new_leader
         accepting_requests = True
         return info.success()
 
 
+# Handles one client request and replies to it. Commands run one at a time under state_lock
+# since they share the globals and RInfo's reply dict, logging and replying happen outside it.
+# A command that raises (e.g. on a parameter that is not a number) is answered with FAILURE
+def serve_request(sock, msg, addr):
+    client_command = msg.decode('utf-8', 'replace')
+    with state_lock:
+        try:
+            command_response = handle_command(client_command)
+        except Exception as e:
+            print("\nCould not handle '" + client_command + "': " + repr(e))
+            info = RInfo()
+            info.set_msg("Invalid command: " + repr(e))
+            command_response = info.failure()
+        msg_to_send = DHTCodec.encode(command_response, wire_format)
+        status = str(command_response["code"])
+
+    # Print messages
+    print("\nMessage from client: " + client_command + "\nClient IP Address: " + str(addr) + "\nStatus: " + status)
+
+    # Reply to client
+    sock.sendto(msg_to_send, addr)
+
+
+# Receives and handles requests forever, run by every worker thread on the same socket. An
+# error with one request is logged and the worker goes on to the next
+def serve_forever(sock):
+    while True:
+        try:
+            msg, addr = sock.recvfrom(65535)
+            serve_request(sock, msg, addr)
+        except Exception as e:
+            print("\nCould not serve a request: " + repr(e))
+
+
 # Used to map commands to the respective functions
 valid_commands = dict(
     register=register,
@@ -410,6 +480,8 @@ valid_commands = dict(
     setup_dht=setup_dht,
     dht_complete=dht_complete,
     query_dht=query_dht,
+    mquery_dht=query_dht,
+    scan_dht=query_dht,
     leave_dht=leave_dht,
     join_dht=join_dht,
     teardown_dht=teardown_dht,
@@ -421,10 +493,12 @@ valid_commands = dict(
 if __name__ == '__main__':
 
     # Retrieve arguments
-    if len(sys.argv) == 2:
+    if len(sys.argv) in (2, 3):
         PORT = int(sys.argv[1])
     else:
         PORT = -1
+    if len(sys.argv) == 3:
+        server_workers = int(sys.argv[2])
 
     # Set HOST and PORT numbers to listen on
     port_prompt = 'Input port to listen (' + str(port_min) + '-' + str(port_max) + '): '
@@ -437,22 +511,10 @@ if __name__ == '__main__':
     sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
     sock.bind((HOST, PORT))
 
-    while True:
-        # Receive message
-        msg, addr = sock.recvfrom(65535)
-        client_command = msg.decode('utf-8')
-        clientMsg = f"Message from client: {client_command}"
-        clientIP = f"Client IP Address: {addr}"
-
-        # Determine what to do with command
-        command_response = handle_command(client_command)
-        msg_to_send = pickle.dumps(command_response)
-
-        # Print messages
-        print("\n" + clientMsg)
-        print(clientIP)
-        print("Status: " + str(command_response["code"]))
-
-        # Reply to client
-        sock.sendto(msg_to_send, addr)
-        del msg_to_send
+    # Each worker waits on the socket itself, so a slow request only holds up its own thread
+    for i in range(server_workers):
+        threading.Thread(target=serve_forever, args=(sock,), daemon=True).start()
+    if server_workers > 0:
+        threading.Event().wait()
+    else:
+        serve_forever(sock)
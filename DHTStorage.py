@@ -0,0 +1,621 @@
+# Zachary Garrett
+
+import os
+import mmap
+import struct
+import hashlib
+import threading
+from array import array
+from bisect import bisect_left
+from operator import attrgetter
+import DHTCodec
+
+record_types = dict()   # Record class of every csv header seen so far
+plain_rows = 4096   # Rows a column holds before it checks, at every power of two, whether coding pays off
+
+
+# A stored row. Values live in __slots__ named c0, c1, ... and the column names
+# are kept once per header on the class instead of once per row
+class Record:
+    __slots__ = ()
+    header = ()
+
+    def __init__(self, values):
+        for slot, value in zip(self.__slots__, values):
+            setattr(self, slot, value)
+
+    # Rebuilds the row as a dict of column name -> value
+    def as_dict(self):
+        values = self.get_values(self)
+        if len(self.header) == 1:
+            values = (values,)
+        return dict(zip(self.header, values))
+
+
+# Returns the Record class for rows with the given columns
+def record_type(header):
+    header = tuple(header)
+    cls = record_types.get(header)
+    if cls is None:
+        slots = tuple("c" + str(i) for i in range(len(header)))
+        cls = type("Record", (Record,), dict(__slots__=slots, header=header, get_values=attrgetter(*slots)))
+        record_types[header] = cls
+    return cls
+
+
+# Rows stored on one node, keyed by the full key so rows whose hashes collide are all kept.
+# Backed by a dict, which grows as rows are added
+class NodeStore:
+
+    def __init__(self, key_column="Long Name"):
+        self.key_column = key_column
+        self.rows = dict()
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __contains__(self, key):
+        return key in self.rows
+
+    # Stores a row dict, replacing the row that has the same key
+    def put(self, row):
+        self.rows[row[self.key_column]] = record_type(row)(row.values())
+
+    # Returns the row dict stored under key, or None
+    def get(self, key):
+        record = self.rows.get(key)
+        return None if record is None else record.as_dict()
+
+    # Removes the row stored under key, returns True if there was one
+    def remove(self, key):
+        return self.rows.pop(key, None) is not None
+
+    def keys(self):
+        return self.rows.keys()
+
+    def clear(self):
+        self.rows.clear()
+
+
+# One column of a ColumnStore. Every distinct value is kept once and rows hold its 4-byte
+# code. A column whose values are mostly distinct (like the key) drops the codes and keeps
+# a value per row, since the codes would only add to the values
+class Column:
+    __slots__ = ("codes", "values", "value_codes")
+
+    def __init__(self):
+        self.codes = array('I')
+        self.values = []    # Distinct values by code, or the value of every row once value_codes is None
+        self.value_codes = dict()   # value -> code
+
+    def __len__(self):
+        return len(self.values) if self.value_codes is None else len(self.codes)
+
+    def append(self, value):
+        if self.value_codes is None:
+            self.values.append(value)
+            return
+        code = self.value_codes.get(value)
+        if code is None:
+            code = self.value_codes[value] = len(self.values)
+            self.values.append(value)
+        self.codes.append(code)
+        rows = len(self.codes)
+        if rows >= plain_rows and rows & (rows - 1) == 0 and len(self.values) > rows // 2:
+            self.values = [self.values[code] for code in self.codes]
+            self.codes = array('I')
+            self.value_codes = None
+
+    def get(self, row):
+        return self.values[row] if self.value_codes is None else self.values[self.codes[row]]
+
+    # Moves the value of the last row into row and drops the last row
+    def move_last(self, row):
+        rows = self.values if self.value_codes is None else self.codes
+        rows[row] = rows[-1]
+        rows.pop()
+        if self.value_codes is not None and len(self.values) > 2 * len(self.codes) + plain_rows:
+            self.recode()
+
+    # Drops the values no row uses anymore
+    def recode(self):
+        values = [self.values[code] for code in self.codes]
+        self.codes = array('I')
+        self.values = []
+        self.value_codes = dict()
+        for value in values:
+            self.append(value)
+
+
+# Rows of one csv header stored column by column, with the row number of every key
+class ColumnTable:
+
+    def __init__(self, header, key_position):
+        self.header = header
+        self.key_position = key_position
+        self.columns = [Column() for column in header]
+        self.index = dict()     # key -> row number
+
+    def put(self, key, values):
+        self.remove(key)
+        self.index[key] = len(self.columns[0])
+        for column, value in zip(self.columns, values):
+            column.append(value)
+
+    def get(self, key):
+        row = self.index.get(key)
+        return None if row is None else dict(zip(self.header, [column.get(row) for column in self.columns]))
+
+    # Fills the row of key with the last row so the columns stay dense
+    def remove(self, key):
+        row = self.index.pop(key, None)
+        if row is None:
+            return False
+        last = len(self.columns[0]) - 1
+        if row != last:
+            self.index[self.columns[self.key_position].get(last)] = row
+        for column in self.columns:
+            column.move_last(row)
+        return True
+
+
+# Rows stored on one node column by column. Each header is kept once, a repeated value like
+# a region or currency is kept once per column, and a row dict is only built when a row is
+# read. Same interface as NodeStore, reads and writes are slower
+class ColumnStore:
+
+    def __init__(self, key_column="Long Name"):
+        self.key_column = key_column
+        self.tables = dict()    # header -> ColumnTable
+
+    def __len__(self):
+        return sum(len(table.index) for table in self.tables.values())
+
+    def __contains__(self, key):
+        return any(key in table.index for table in self.tables.values())
+
+    # Stores a row dict, replacing the row that has the same key
+    def put(self, row):
+        header = tuple(row)
+        table = self.tables.get(header)
+        if table is None:
+            table = self.tables[header] = ColumnTable(header, header.index(self.key_column))
+        key = row[self.key_column]
+        if len(self.tables) > 1:
+            for other in self.tables.values():
+                if other is not table:
+                    other.remove(key)
+        table.put(key, row.values())
+
+    # Returns the row dict stored under key, or None
+    def get(self, key):
+        for table in self.tables.values():
+            if key in table.index:
+                return table.get(key)
+        return None
+
+    # Removes the row stored under key, returns True if there was one
+    def remove(self, key):
+        return any(table.remove(key) for table in self.tables.values())
+
+    def keys(self):
+        return [key for table in self.tables.values() for key in table.index]
+
+    def clear(self):
+        self.tables.clear()
+
+
+# magic, version, headers, generation, capacity, rows, used slots, heap end, garbage bytes, digest
+index_header = struct.Struct('!8sIIQQQQQQ16s')
+index_start = 128   # First byte of the index slots
+slot = struct.Struct('!QQ')     # key hash, heap offset + 2 (0 for an empty slot, 1 for a removed row)
+heap_header = struct.Struct('!8sQ')     # magic, generation
+heap_start = 64     # First byte of the heap entries
+entry_length = struct.Struct('!I')
+snapshot_version = 1
+min_capacity = 1024     # Index slots of a new snapshot
+min_heap = 1024 * 1024  # Bytes of a new heap file, and the least garbage worth compacting
+
+
+# Rows stored on one node in memory-mapped files, so they survive a restart or a teardown and
+# are back in milliseconds. The heap file holds every row as a length and its packed values,
+# appended as rows arrive. The index file is a fixed-size open-addressing table of key hash
+# -> heap offset, doubled when it is half full, and the header list is kept in a third file.
+# A snapshot is tagged with a digest of the members and settings it was stored under and is
+# only reused by open with the same digest. Writes reach the page cache right away and disk
+# when the kernel writes them back or the store is closed, so a crashed process loses
+# nothing but a crashed machine can lose the last rows
+class SnapshotStore:
+
+    def __init__(self, key_column="Long Name"):
+        self.key_column = key_column
+        self.path = None
+        self.index = None   # mmap of the index file, None until open
+        self.heap = None
+        self.headers = []
+        self.header_numbers = dict()
+        self.state = None   # [generation, capacity, count, used, heap end, garbage]
+        self.digest = b''
+
+    # Maps the snapshot at path. Returns True if it was stored under digest and is kept,
+    # otherwise it is emptied and tagged with digest. An open store only takes the new digest
+    def open(self, path, digest):
+        digest = hashlib.blake2b(digest.encode('utf-8'), digest_size=16).digest()
+        if self.index is not None and self.path == path:
+            self.digest = digest
+            self.write_state()
+            return False
+        self.close()
+        self.path = path
+        try:
+            restored = self.map_files() and self.digest == digest
+        except (OSError, ValueError, DHTCodec.CodecError):
+            restored = False
+        if not restored:
+            self.create(digest)
+        return restored
+
+    # Flushes and unmaps the files, the rows stay on disk for the next open
+    def close(self):
+        if self.index is not None:
+            self.heap.flush()
+            self.index.flush()
+            self.heap.close()
+            self.index.close()
+        self.index = None
+        self.heap = None
+        self.state = None
+
+    # Maps the files at self.path, returns False unless they are a complete snapshot
+    def map_files(self):
+        if not all(os.path.exists(self.path + suffix) for suffix in (".index", ".heap", ".headers")):
+            return False
+        with open(self.path + ".headers", 'rb') as header_file:
+            headers = DHTCodec.unpack_value(header_file.read())
+        index = map_file(self.path + ".index")
+        heap = map_file(self.path + ".heap")
+        magic, version, header_count, generation, capacity, count, used, heap_end, garbage, digest = \
+            index_header.unpack_from(index, 0)
+        heap_magic, heap_generation = heap_header.unpack_from(heap, 0)
+        if (magic, heap_magic, version) != (b'DHTSNAP\0', b'DHTHEAP\0', snapshot_version) or \
+                generation != heap_generation or header_count > len(headers) or \
+                len(index) != index_start + capacity * slot.size or heap_end > len(heap):
+            index.close()
+            heap.close()
+            return False
+        self.index = index
+        self.heap = heap
+        self.headers = [tuple(header) for header in headers]
+        self.header_numbers = dict((header, i) for i, header in enumerate(self.headers))
+        self.state = [generation, capacity, count, used, heap_end, garbage]
+        self.digest = digest
+        return True
+
+    # Replaces the files with an empty snapshot tagged with digest
+    def create(self, digest, generation=0):
+        self.close()
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        self.headers = []
+        self.header_numbers = dict()
+        self.write_headers()
+        write_file(self.path + ".heap", heap_header.pack(b'DHTHEAP\0', generation).ljust(min_heap, b'\0'))
+        write_file(self.path + ".index", bytes(index_start + min_capacity * slot.size))
+        self.index = map_file(self.path + ".index")
+        self.heap = map_file(self.path + ".heap")
+        self.state = [generation, min_capacity, 0, 0, heap_start, 0]
+        self.digest = digest
+        self.write_state()
+
+    def write_state(self):
+        generation, capacity, count, used, heap_end, garbage = self.state
+        index_header.pack_into(self.index, 0, b'DHTSNAP\0', snapshot_version, len(self.headers), generation,
+                               capacity, count, used, heap_end, garbage, self.digest)
+
+    def write_headers(self):
+        write_file(self.path + ".headers", DHTCodec.pack_value([list(header) for header in self.headers]))
+
+    def __len__(self):
+        return 0 if self.state is None else self.state[2]
+
+    def __contains__(self, key):
+        return self.find(key)[1] is not None
+
+    # Returns the slot of key and its row, or the slot a new key would take and None
+    def find(self, key):
+        if self.index is None:
+            return None, None
+        key_hash = hash_key(key)
+        capacity = self.state[1]
+        i = key_hash & (capacity - 1)
+        free = None
+        while True:
+            slot_hash, offset = slot.unpack_from(self.index, index_start + i * slot.size)
+            if offset == 0:
+                return (i if free is None else free), None
+            if offset == 1:
+                free = i if free is None else free
+            elif slot_hash == key_hash:
+                row = self.read(offset - 2)
+                if row[self.key_column] == key:
+                    return i, row
+            i = (i + 1) & (capacity - 1)
+
+    # Row dict of the heap entry at offset
+    def read(self, offset):
+        length = entry_length.unpack_from(self.heap, offset)[0]
+        header, values = DHTCodec.unpack_value(self.heap[offset + 4:offset + 4 + length])
+        return dict(zip(self.headers[header], values))
+
+    # Stores a row dict, replacing the row that has the same key
+    def put(self, row):
+        key = row[self.key_column]
+        header = tuple(row)
+        number = self.header_numbers.get(header)
+        if number is None:
+            number = self.header_numbers[header] = len(self.headers)
+            self.headers.append(header)
+            self.write_headers()
+        data = DHTCodec.pack_value([number, list(row.values())])
+
+        state = self.state
+        if state[4] + 4 + len(data) > len(self.heap):
+            self.heap = grow_file(self.path + ".heap", self.heap, state[4] + 4 + len(data))
+        offset = state[4]
+        self.heap[offset:offset + 4 + len(data)] = entry_length.pack(len(data)) + data
+        state[4] += 4 + len(data)
+
+        i, old = self.find(key)
+        position = index_start + i * slot.size
+        if old is not None:
+            state[5] += 4 + entry_length.unpack_from(self.heap, slot.unpack_from(self.index, position)[1] - 2)[0]
+        else:
+            state[2] += 1
+            if slot.unpack_from(self.index, position)[1] == 0:
+                state[3] += 1
+        slot.pack_into(self.index, position, hash_key(key), offset + 2)
+        self.write_state()
+        if state[3] * 2 > state[1]:
+            self.rebuild(state[1] * 2)
+        elif state[5] > max(min_heap, state[4] - state[5]):
+            self.rebuild(state[1])
+
+    # Returns the row dict stored under key, or None
+    def get(self, key):
+        return self.find(key)[1]
+
+    # Removes the row stored under key, returns True if there was one
+    def remove(self, key):
+        i, row = self.find(key)
+        if row is None:
+            return False
+        position = index_start + i * slot.size
+        key_hash, offset = slot.unpack_from(self.index, position)
+        self.state[5] += 4 + entry_length.unpack_from(self.heap, offset - 2)[0]
+        self.state[2] -= 1
+        slot.pack_into(self.index, position, key_hash, 1)
+        self.write_state()
+        return True
+
+    def keys(self):
+        if self.index is None:
+            return []
+        keys = []
+        for i in range(self.state[1]):
+            offset = slot.unpack_from(self.index, index_start + i * slot.size)[1]
+            if offset > 1:
+                keys.append(self.read(offset - 2)[self.key_column])
+        return keys
+
+    # Empties the snapshot, keeping its digest
+    def clear(self):
+        if self.index is not None:
+            self.create(self.digest)
+
+    # Writes the live rows to a new heap and index of capacity slots. The heap is replaced
+    # before the index and both carry the next generation, so a crash in between leaves a
+    # snapshot that open rejects
+    def rebuild(self, capacity):
+        generation = self.state[0] + 1
+        heap = bytearray(heap_header.pack(b'DHTHEAP\0', generation).ljust(heap_start, b'\0'))
+        index = bytearray(index_start + capacity * slot.size)
+        count = 0
+        for i in range(self.state[1]):
+            key_hash, offset = slot.unpack_from(self.index, index_start + i * slot.size)
+            if offset < 2:
+                continue
+            length = entry_length.unpack_from(self.heap, offset - 2)[0]
+            j = key_hash & (capacity - 1)
+            while slot.unpack_from(index, index_start + j * slot.size)[1] != 0:
+                j = (j + 1) & (capacity - 1)
+            slot.pack_into(index, index_start + j * slot.size, key_hash, len(heap) + 2)
+            heap += self.heap[offset - 2:offset + 2 + length]
+            count += 1
+        heap_end = len(heap)
+        heap += bytes(max(min_heap, heap_end * 2) - heap_end)
+
+        self.close()
+        write_file(self.path + ".heap", heap)
+        write_file(self.path + ".index", index)
+        self.index = map_file(self.path + ".index")
+        self.heap = map_file(self.path + ".heap")
+        self.state = [generation, capacity, count, count, heap_end, 0]
+        self.write_state()
+
+
+# Any store with an ordered index of its keys and, for each of columns, an index of value ->
+# keys, for range, prefix and value scans. The index is built on the first scan and kept up
+# to date from then on, so a node that is never scanned pays nothing. Keys stored or removed
+# since the last scan wait in changes and are merged into the sorted keys by the next one,
+# where appending them and sorting again costs little more than a pass over the keys
+class IndexedStore:
+
+    def __init__(self, store, columns=()):
+        self.store = store
+        self.columns = tuple(columns)
+        self.lock = threading.Lock()    # Scans merge under it while other scans read
+        self.sorted_keys = []
+        self.changes = dict()   # key -> True if it was stored since the merge, False if it was removed
+        self.values = dict()    # column -> {value -> set of keys}
+        self.stale = True   # Index not built, or the store changed under it
+
+    def __len__(self):
+        return len(self.store)
+
+    def __contains__(self, key):
+        return key in self.store
+
+    def __getattr__(self, name):
+        return getattr(self.store, name)
+
+    @property
+    def key_column(self):
+        return self.store.key_column
+
+    # The sorted keys are rebuilt only when the key column changes, each migrated batch sets it again
+    @key_column.setter
+    def key_column(self, key_column):
+        if key_column != self.store.key_column:
+            self.store.key_column = key_column
+            self.stale = True
+
+    # Stores a row dict, replacing the row that has the same key
+    def put(self, row):
+        with self.lock:
+            if not self.stale:
+                key = row[self.store.key_column]
+                if key in self.store:
+                    self.unindex(key, self.store.get(key) if self.columns else None)
+                else:
+                    self.change(key, True)
+                self.index(key, row)
+            self.store.put(row)
+
+    def get(self, key):
+        return self.store.get(key)
+
+    # Removes the row stored under key, returns True if there was one
+    def remove(self, key):
+        with self.lock:
+            if not self.stale and key in self.store:
+                self.unindex(key, self.store.get(key) if self.columns else None)
+                self.change(key, False)
+            return self.store.remove(key)
+
+    def keys(self):
+        return self.store.keys()
+
+    def clear(self):
+        with self.lock:
+            self.store.clear()
+            self.stale = True
+
+    # Opens a store kept on disk, whose rows the index has not seen
+    def open(self, path, digest):
+        with self.lock:
+            self.stale = True
+            return self.store.open(path, digest)
+
+    def close(self):
+        return self.store.close()
+
+    # Notes that key was stored (True) or removed, a change that undoes the last one cancels it
+    def change(self, key, stored):
+        if self.changes.get(key, stored) != stored:
+            del self.changes[key]
+        else:
+            self.changes[key] = stored
+
+    def index(self, key, row):
+        for column in self.columns:
+            if column in row:
+                self.values[column].setdefault(row[column], set()).add(key)
+
+    def unindex(self, key, row):
+        for column in self.columns:
+            keys = self.values[column].get(row.get(column)) if row is not None else None
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self.values[column][row.get(column)]
+
+    # Builds the index over every stored row, or merges the changes since the last scan
+    def refresh(self):
+        if self.stale:
+            self.sorted_keys = sorted(self.store.keys())
+            self.changes.clear()
+            self.values = dict((column, dict()) for column in self.columns)
+            for key in self.sorted_keys if self.columns else ():
+                self.index(key, self.store.get(key))
+            self.stale = False
+        elif self.changes:
+            removed = set(key for key, stored in self.changes.items() if not stored)
+            keys = [key for key in self.sorted_keys if key not in removed] if removed else list(self.sorted_keys)
+            keys.extend(key for key, stored in self.changes.items() if stored)
+            keys.sort()
+            self.sorted_keys = keys
+            self.changes.clear()
+
+    # Returns the keys in order that start with prefix, are in [start, end) and whose row
+    # holds value in column, leaving out the conditions that are None. A column without an
+    # index is matched by reading the rows in the key range
+    def scan(self, prefix=None, start=None, end=None, column=None, value=None):
+        with self.lock:
+            self.refresh()
+            keys = self.sorted_keys     # A merge replaces the list instead of changing it
+            wanted = set(self.values[column].get(value, ())) if column in self.values else None
+        low = 0 if start is None else bisect_left(keys, start)
+        high = len(keys) if end is None else bisect_left(keys, end)
+        if prefix:
+            low = max(low, bisect_left(keys, prefix))
+            if ord(prefix[-1]) < 0x10FFFF:
+                high = min(high, bisect_left(keys, prefix[:-1] + chr(ord(prefix[-1]) + 1)))
+        if column is None:
+            return keys[low:high]
+        if wanted is None:
+            return [key for key in keys[low:high] if (self.store.get(key) or dict()).get(column) == value]
+        if len(wanted) < high - low:
+            return [key for key in sorted(wanted) if (not prefix or key.startswith(prefix)) and
+                    (start is None or key >= start) and (end is None or key < end)]
+        return [key for key in keys[low:high] if key in wanted]
+
+
+# 64-bit hash of a key for the snapshot index, independent of the DHT's hash function
+def hash_key(key):
+    return int.from_bytes(hashlib.blake2b(str(key).encode('utf-8', 'surrogatepass'), digest_size=8).digest(), 'big')
+
+
+# Maps the whole file at path for reading and writing
+def map_file(path):
+    with open(path, 'r+b') as mapped:
+        return mmap.mmap(mapped.fileno(), 0)
+
+
+# Writes data to a temporary file and moves it over path
+def write_file(path, data):
+    with open(path + ".tmp", 'wb') as out:
+        out.write(data)
+    os.replace(path + ".tmp", path)
+
+
+# Extends the mapped file at path to at least size bytes, doubling it, and maps it again
+def grow_file(path, mapped, size):
+    mapped.flush()
+    new_size = max(size, len(mapped) * 2)
+    mapped.close()
+    with open(path, 'r+b') as grown:
+        grown.truncate(new_size)
+    return map_file(path)
+
+
+# Node stores by name
+stores = dict(
+    records=NodeStore,
+    columns=ColumnStore,
+    snapshot=SnapshotStore
+)
+
+
+# A store of the given name (one of stores) with an ordered key index and an index of each
+# of indexed_columns
+def new_store(name, key_column="Long Name", indexed_columns=()):
+    return IndexedStore(stores[name](key_column), indexed_columns)
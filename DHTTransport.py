@@ -0,0 +1,562 @@
+# Zachary Garrett
+
+import socket
+import select
+import struct
+import random
+import threading
+import collections
+from time import monotonic, time_ns
+
+send_sock = None    # Socket every datagram of this process is sent from
+owns_sock = False   # True when send_sock was opened here (and has to be closed here)
+drop_rate = 0.0     # Fraction of datagrams thrown away instead of sent, to test loss recovery on loopback
+
+# Reliable channel. Frames start with frame_magic (DHTCodec messages start with 0xD7, pickles with 0x80)
+frame_magic = 0xD8
+data_frame = struct.Struct('!BBQII')    # magic, 'D', channel epoch, sequence number, lowest sequence not acked
+# magic, 'A', channel epoch, every sequence number up to this one arrived, bit i: this one + 2 + i arrived too,
+# sequence number of the frame that arrived last
+ack_frame = struct.Struct('!BBQIQI')
+window = 256    # Most unacked frames to one address, the congestion window never grows past it
+initial_window = 4  # Congestion window of a new channel, it grows with every acked frame
+congestion_control = True   # Grow the window with acks and halve it when a queue builds (AIMD), False keeps it at window
+queue_delay = 0.02  # Seconds a round trip may take longer than the shortest one before the window is halved
+buffered_max = 1024     # Most frames past a gap a receiver keeps for one sender
+initial_rto = 0.2   # Seconds before the first frame to an address is resent
+min_rto = 0.02
+max_rto = 2.0
+max_retries = 10    # Timeouts in a row after which the frames to an address are dropped
+last_epoch = 0
+
+channels = dict()   # address -> Channel of the frames sent to it
+streams = dict()    # address -> Stream of the frames received from it
+ack_due = set()     # Addresses whose frames were received since acks were last sent
+channel_lock = threading.Condition()
+# Stream transport. Messages to a peer go over one TCP connection to its left port, each prefixed by its length
+length_prefix = struct.Struct('!I')
+read_bytes = 256 * 1024     # Size of the buffer a connection is read into, a longer message gets a larger one
+queued_max = 4 * 1024 * 1024    # Bytes waiting to be written to one connection before senders wait
+connect_timeout = 3     # Seconds to open a connection
+reconnect_delay = 0.5   # Seconds messages to a peer are dropped after a failed connect, doubled per failure in a row
+reconnect_max = 30  # Longest reconnect delay
+connections = dict()    # address -> Connection that sends to it
+connections_lock = threading.Lock()
+
+# datagrams_sent, datagrams_received, dropped (by drop_rate), frames sent, retransmits (fast_retransmits of
+# them), probes, timeouts, window_cuts, duplicates, reordered, acks, given_up, send_errors,
+# stream_messages, stream_writes, stream_dropped
+stats = collections.Counter()
+
+
+# Frames sent to one address. Their round trip times give the retransmit timeout like TCP
+# (RFC 6298): a single timer resends the frames not known to have arrived and doubles the
+# timeout. How many frames may be unacked follows TCP Reno (RFC 5681): the window starts at
+# initial_window, grows by one frame per acked frame up to ssthresh and by one frame per
+# window after it, and halves when a round trip takes queue_delay longer than the shortest
+# one (frames queue in the receive buffer before it overflows) or the timer runs out. Frames
+# missing between acked ones are resent without halving: cutting the window on every loss
+# would keep it at a few frames under random loss, leaving every recovery to the timer.
+# Two round trips without an ack first resend only the newest frame, whose ack tells which
+# frames are missing, before the timer resends them all.
+# Sequence numbers start at 1 in every channel, and the epoch of a channel is larger than
+# that of any channel opened before it, also by an earlier run of this process, so the
+# receiver knows to start over
+class Channel:
+
+    def __init__(self):
+        global last_epoch
+        last_epoch = self.epoch = max(time_ns() // 1000, last_epoch + 1)
+        self.next_seq = 1
+        self.unacked = collections.OrderedDict()    # seq -> [frame, time last sent, resent, arrived after a gap]
+        self.waiting = collections.deque()  # Frames past the window, sent as acks arrive
+        self.srtt = None
+        self.rttvar = 0.0
+        self.rto = initial_rto
+        self.deadline = None
+        self.probed = False     # The newest frame was resent since the last progress
+        self.tries = 0
+        self.cwnd = float(initial_window if congestion_control else window)
+        self.ssthresh = float(window)
+        self.recover = 0    # Signals from frames before this one belong to the last cut of the window
+        self.min_rtt = None
+
+    # Most frames that may be unacked now
+    def limit(self):
+        return max(1, min(int(self.cwnd), window)) if congestion_control else window
+
+    # Grows the window for newly acked frames
+    def grow(self, frames):
+        if not congestion_control:
+            return
+        for i in range(frames):
+            self.cwnd += 1.0 if self.cwnd < self.ssthresh else 1.0 / self.cwnd
+        self.cwnd = min(self.cwnd, float(window))
+
+    # Seconds until the timer runs out: two round trips for the tail loss probe, then the timeout
+    def timer(self):
+        return self.rto if self.probed or self.srtt is None else min(max(2 * self.srtt, min_rto), self.rto)
+
+    # Halves the window, once per window of frames sent
+    def cut(self, seq):
+        if congestion_control and seq >= self.recover:
+            self.ssthresh = self.cwnd = max(self.cwnd / 2, float(initial_window))
+            self.recover = self.next_seq
+            stats["window_cuts"] += 1
+
+
+# Frames received from one address: the next sequence number to deliver and the frames after a gap
+class Stream:
+
+    def __init__(self, sender_epoch, expected):
+        self.epoch = sender_epoch
+        self.expected = expected
+        self.buffered = dict()
+        self.last_seq = 0
+
+
+# Connection that sends to one address. Messages are queued with their length in front and a
+# writer thread sends all that were queued since its last write in one call, so a burst of
+# small messages costs one system call instead of one each. The writer thread also connects,
+# so no sender waits for the connect. Messages queued meanwhile are sent once it connects,
+# or dropped if it fails, and then new messages are dropped until retry_at
+class Connection:
+
+    def __init__(self, addr, failures=0):
+        self.addr = addr
+        self.sock = None
+        self.queued = []
+        self.queued_bytes = 0
+        self.closed = False
+        self.failures = failures    # Failed connects in a row to addr
+        self.retry_at = 0.0     # Time before which no new connection to addr is tried
+        self.ready = threading.Condition()
+        self.writer = threading.Thread(target=self.write, daemon=True)
+        self.writer.start()
+
+    # Queues a message, with block waiting while queued_max bytes are waiting. False if the
+    # connection is closed
+    def put(self, data, block=True):
+        with self.ready:
+            while block and self.queued_bytes >= queued_max and not self.closed:
+                self.ready.wait()
+            if self.closed:
+                return False
+            self.queued.append(length_prefix.pack(len(data)))
+            self.queued.append(data)
+            self.queued_bytes += length_prefix.size + len(data)
+            self.ready.notify_all()
+        return True
+
+    # Writer thread: connects, then sends what was queued until the connection is closed and
+    # nothing is left
+    def write(self):
+        try:
+            self.sock = socket.create_connection(self.addr, connect_timeout)
+            self.sock.settimeout(None)
+            self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        except OSError as e:
+            print("Could not connect to " + str(self.addr) + ": " + repr(e))
+            with self.ready:
+                self.closed = True
+                self.failures += 1
+                self.retry_at = monotonic() + min(reconnect_delay * 2 ** (self.failures - 1), reconnect_max)
+                stats["stream_dropped"] += len(self.queued) // 2
+                self.queued = []
+                self.ready.notify_all()
+            return
+        self.failures = 0
+        while True:
+            with self.ready:
+                while not self.queued and not self.closed:
+                    self.ready.wait()
+                if not self.queued:
+                    break
+                chunks = self.queued
+                self.queued = []
+                self.queued_bytes = 0
+                self.ready.notify_all()
+            stats["stream_writes"] += 1
+            try:
+                self.sock.sendall(b''.join(chunks))
+            except OSError as e:
+                print("Connection to " + str(self.addr) + " lost: " + repr(e))
+                with self.ready:
+                    self.closed = True
+                    stats["stream_dropped"] += len(chunks) // 2 + len(self.queued) // 2
+                    self.queued = []
+                    self.ready.notify_all()
+                break
+        self.sock.close()
+
+    # Stops taking messages, the writer sends those already queued and closes the socket
+    def close(self):
+        with self.ready:
+            self.closed = True
+            self.ready.notify_all()
+
+
+# Reads the length prefixed messages of one accepted connection into a buffer it reuses.
+# Messages are returned as memoryview slices of the buffer instead of copies, they are
+# valid until the next read
+class StreamReader:
+
+    def __init__(self, peer):
+        self.peer = peer
+        self.buffer = bytearray(read_bytes)
+        self.view = memoryview(self.buffer)
+        self.start = 0  # First byte of the buffer not returned yet
+        self.end = 0    # Bytes of the buffer that were read
+
+    # Reads what sock has and returns the messages it completed, None once the peer closed
+    def read(self, sock):
+        if self.start:
+            # Move the start of an incomplete message to the front
+            self.buffer[:self.end - self.start] = bytes(self.view[self.start:self.end])
+            self.end -= self.start
+            self.start = 0
+        try:
+            count = sock.recv_into(self.view[self.end:])
+        except BlockingIOError:
+            return []
+        except OSError:
+            return None
+        if not count:
+            return None
+        self.end += count
+
+        messages = []
+        while self.end - self.start >= length_prefix.size:
+            length = length_prefix.unpack_from(self.buffer, self.start)[0]
+            first = self.start + length_prefix.size
+            if self.end < first + length:
+                if first + length - self.start > len(self.buffer):
+                    self.grow(first + length - self.start)
+                break
+            messages.append(self.view[first:first + length])
+            self.start = first + length
+        stats["stream_messages"] += len(messages)
+        return messages
+
+    # Replaces the buffer with one of size bytes that starts with the incomplete message
+    def grow(self, size):
+        buffer = bytearray(size)
+        buffer[:self.end - self.start] = self.view[self.start:self.end]
+        self.buffer = buffer
+        self.view = memoryview(buffer)
+        self.end -= self.start
+        self.start = 0
+
+
+# Sends from the given socket (the node's bound left socket) or from a new unbound one
+def open_sender(sock=None):
+    global send_sock, owns_sock
+    close_sender()
+
+    if sock is None:
+        send_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        owns_sock = True
+    else:
+        send_sock = sock
+        owns_sock = False
+
+
+# Stops sending from the current socket, closing it if it was opened by open_sender. The acks
+# of its channels would come back to that socket, so their unacked frames are dropped too
+def close_sender():
+    global send_sock, owns_sock
+    if send_sock is not None and owns_sock:
+        send_sock.close()
+    send_sock = None
+    owns_sock = False
+    close_connections()
+    with channel_lock:
+        channels.clear()
+        streams.clear()
+        ack_due.clear()
+        channel_lock.notify_all()
+
+
+# Asks for receive and send buffers of the given bytes on sock (0 keeps the OS default).
+# Linux caps them at net.core.rmem_max / wmem_max. Returns the sizes the socket got
+def size_buffers(sock, receive=0, send=0):
+    if receive:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, receive)
+    if send:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, send)
+    return sock.getsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF), sock.getsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF)
+
+
+# Datagrams to the UDP port that the kernel dropped, mostly because its receive buffer was
+# full. Read from /proc/net/udp, None where it does not exist
+def receive_drops(port):
+    try:
+        with open('/proc/net/udp') as udp_table:
+            next(udp_table)     # Column names
+            for line in udp_table:
+                fields = line.split()
+                if int(fields[1].rsplit(':', 1)[1], 16) == port:
+                    return int(fields[-1])
+    except (OSError, ValueError, IndexError):
+        return None
+    return None
+
+
+# Sends data to the left port at addr over the stream transport, opening a connection to it
+# the first time. With block, waits while the connection has queued_max bytes to write.
+# Dropped while a failed connect to addr is backing off
+def send_stream(data, addr, block=True):
+    with connections_lock:
+        connection = connections.get(addr)
+        if connection is None or connection.closed:
+            if connection is not None and monotonic() < connection.retry_at:
+                stats["stream_dropped"] += 1    # The last connect failed, wait before trying again
+                return
+            connection = connections[addr] = Connection(addr, 0 if connection is None else connection.failures)
+    if not connection.put(data, block):
+        stats["stream_dropped"] += 1
+
+
+# Closes every connection once what was queued to it is written
+def close_connections():
+    with connections_lock:
+        closing = list(connections.values())
+        connections.clear()
+    for connection in closing:
+        connection.close()
+    for connection in closing:
+        connection.writer.join(connect_timeout)
+
+
+# Sends one datagram to addr, returns False if it could not be sent (e.g. an address of a
+# node that left, or none at all)
+def send_bytes(data, addr):
+    if send_sock is None:
+        open_sender()
+    stats["datagrams_sent"] += 1
+    if drop_rate and random.random() < drop_rate:
+        stats["dropped"] += 1
+        return True
+
+    while True:
+        try:
+            send_sock.sendto(data, addr)
+            return True
+        # Non-blocking socket with a full send buffer, wait until it drains
+        except BlockingIOError:
+            select.select([], [send_sock], [], 1)
+        except OSError as e:
+            stats["send_errors"] += 1
+            print("Could not send to " + str(addr) + ": " + repr(e))
+            return False
+
+
+# Sends data to addr reliably: it is resent until acked and delivered once and in order by
+# accept at addr. With block, waits while the congestion window to addr is full. The
+# listener thread must not block, since it is the one that reads the acks, so its frames
+# wait in a queue
+def send_reliable(data, addr, block=True):
+    with channel_lock:
+        while True:
+            channel = channels.get(addr)
+            if channel is None:
+                channel = Channel()     # First frame, or the last channel was given up
+            if not block or len(channel.unacked) < channel.limit() and not channel.waiting:
+                break
+            channel_lock.wait(max_rto)
+        seq = channel.next_seq
+        channel.next_seq += 1
+        if len(channel.unacked) < channel.limit() and not channel.waiting:
+            sent = send_frame(channel, addr, seq, data)
+        else:
+            channel.waiting.append((seq, data))
+            sent = True
+        channels[addr] = channel
+        if not sent:
+            drop_channel(addr)
+
+
+# Sends a new frame to addr and starts the timer if it is not running. Returns False if it
+# could not be sent
+def send_frame(channel, addr, seq, data):
+    base = next(iter(channel.unacked), seq)
+    frame = data_frame.pack(frame_magic, 0x44, channel.epoch, seq, base) + data
+    channel.unacked[seq] = [frame, monotonic(), False, False]
+    if channel.deadline is None:
+        channel.deadline = monotonic() + channel.timer()
+    stats["sent"] += 1
+    return send_bytes(frame, addr)
+
+
+# Gives up on the frames to addr, which cannot be sent there. The next frame starts a new channel
+def drop_channel(addr):
+    channel = channels.pop(addr, None)
+    if channel is not None:
+        stats["given_up"] += len(channel.unacked) + len(channel.waiting)
+        channel_lock.notify_all()
+
+
+# Handles a datagram from addr and returns the payloads it delivers: none for an ack, a
+# duplicate or a frame after a gap, the payload and the frames buffered after it for the
+# next frame in order, and the datagram itself if it is not a frame
+def accept(data, addr):
+    stats["datagrams_received"] += 1
+    if not data or data[0] != frame_magic:
+        return [data]
+    if data[1] == 0x41 and len(data) == ack_frame.size:
+        handle_ack(data, addr)
+        return []
+    if data[1] != 0x44 or len(data) < data_frame.size:
+        return []
+
+    first, kind, sender_epoch, seq, base = data_frame.unpack_from(data, 0)
+    with channel_lock:
+        stream = streams.get(addr)
+        if stream is None or sender_epoch > stream.epoch:
+            stream = streams[addr] = Stream(sender_epoch, base)     # New channel of the sender
+        elif sender_epoch < stream.epoch:
+            return []   # Late frame of a channel the sender replaced
+        ack_due.add(addr)
+        stream.last_seq = seq
+        if base > stream.expected:
+            # Frames before base were acked, by this receiver before it restarted
+            stream.expected = base
+            stream.buffered = dict((number, frame) for number, frame in stream.buffered.items() if number >= base)
+        if seq < stream.expected or seq in stream.buffered:
+            stats["duplicates"] += 1
+            return []
+        if seq - stream.expected >= buffered_max:
+            return []
+        if seq != stream.expected:
+            stats["reordered"] += 1
+        stream.buffered[seq] = data[data_frame.size:]
+        delivered = []
+        while stream.expected in stream.buffered:
+            delivered.append(stream.buffered.pop(stream.expected))
+            stream.expected += 1
+        return delivered
+
+
+# Sends one ack to every address frames were received from since the last call. Called
+# after the waiting datagrams were read, so a burst is acked once
+def flush_acks():
+    with channel_lock:
+        acks = []
+        for addr in ack_due:
+            stream = streams[addr]
+            received = 0
+            for seq in stream.buffered:
+                if seq - stream.expected <= 64:
+                    received |= 1 << (seq - stream.expected - 1)
+            acks.append((addr, ack_frame.pack(frame_magic, 0x41, stream.epoch, stream.expected - 1, received,
+                                              stream.last_seq)))
+        ack_due.clear()
+    for addr, frame in acks:
+        stats["acks"] += 1
+        send_bytes(frame, addr)
+
+
+# Drops the frames an ack covers and marks the ones it says arrived after a gap, growing the
+# window by as many frames. The round trip time is sampled from the frame that arrived last,
+# unless it was resent, since a frame acked only once the gap before it closed would time the
+# gap instead, and halves the window if it is queue_delay longer than the shortest. A frame
+# missing before one that arrived is resent right away, at most once per round trip, instead
+# of waiting for the timer. Then sends the waiting frames that now fit in the window
+def handle_ack(data, addr):
+    first, kind, acked_epoch, acked, received, last_seq = ack_frame.unpack(data)
+    with channel_lock:
+        channel = channels.get(addr)
+        if channel is None or acked_epoch != channel.epoch:
+            return
+        now = monotonic()
+        last = channel.unacked.get(last_seq)
+        sample = None if last is None or last[2] or last[3] else now - last[1]
+        arrived = 0
+        while channel.unacked and next(iter(channel.unacked)) <= acked:
+            seq, entry = channel.unacked.popitem(last=False)
+            arrived += not entry[3]
+        highest = acked
+        for i in range(64):
+            if received >> i & 1:
+                highest = acked + 2 + i
+                entry = channel.unacked.get(highest)
+                if entry is not None and not entry[3]:
+                    entry[3] = True
+                    arrived += 1
+        channel.grow(arrived)
+        if sample is not None:
+            channel.min_rtt = sample if channel.min_rtt is None else min(channel.min_rtt, sample)
+            if sample > channel.min_rtt + queue_delay:
+                channel.cut(last_seq)
+            if channel.srtt is None:
+                channel.srtt = sample
+                channel.rttvar = sample / 2
+            else:
+                channel.rttvar = 0.75 * channel.rttvar + 0.25 * abs(channel.srtt - sample)
+                channel.srtt = 0.875 * channel.srtt + 0.125 * sample
+            channel.rto = min(max(channel.srtt + 4 * channel.rttvar, min_rto), max_rto)
+
+        for seq, entry in channel.unacked.items():
+            if seq >= highest:
+                break
+            if not entry[3] and now - entry[1] > (channel.srtt or channel.rto):
+                stats["fast_retransmits"] += 1
+                if not resend(entry, addr, now):
+                    drop_channel(addr)
+                    return
+        if arrived:
+            channel.tries = 0
+            while channel.waiting and len(channel.unacked) < channel.limit():
+                if not send_frame(channel, addr, *channel.waiting.popleft()):
+                    drop_channel(addr)
+                    return
+            channel.probed = False
+            channel.deadline = now + channel.timer() if channel.unacked else None
+            channel_lock.notify_all()
+
+
+# Sends an unacked frame to addr again, returns False if it could not be sent
+def resend(entry, addr, now):
+    entry[1] = now
+    entry[2] = True
+    stats["retransmits"] += 1
+    return send_bytes(entry[0], addr)
+
+
+# Resends the frames not known to have arrived to every address whose timer ran out and
+# doubles its timeout. Gives up on an address after max_retries timeouts in a row. Returns
+# the seconds until the next timer runs out, or None if no frame is waiting for an ack
+def retransmit():
+    now = monotonic()
+    next_deadline = None
+    with channel_lock:
+        for addr, channel in list(channels.items()):
+            if channel.deadline is None:
+                continue
+            if channel.deadline <= now and not channel.probed and channel.srtt is not None:
+                # Tail loss probe (RFC 8985): the ack of the newest frame says which frames are missing
+                channel.probed = True
+                channel.deadline = now + channel.timer()
+                stats["probes"] += 1
+                if not resend(next(reversed(channel.unacked.values())), addr, now):
+                    drop_channel(addr)
+                    continue
+            elif channel.deadline <= now:
+                channel.tries += 1
+                if channel.tries > max_retries:
+                    stats["given_up"] += len(channel.unacked) + len(channel.waiting)
+                    del channels[addr]
+                    channel_lock.notify_all()
+                    print("No acks from " + str(addr) + ", dropped " + str(len(channel.unacked) +
+                                                                          len(channel.waiting)) + " frames")
+                    continue
+                stats["timeouts"] += 1
+                channel.rto = min(channel.rto * 2, max_rto)
+                channel.deadline = now + channel.rto
+                channel.cut(channel.recover)
+                if not all(resend(entry, addr, now) for entry in channel.unacked.values() if not entry[3]):
+                    drop_channel(addr)
+                    continue
+            if next_deadline is None or channel.deadline < next_deadline:
+                next_deadline = channel.deadline
+    return None if next_deadline is None else max(next_deadline - now, 0)